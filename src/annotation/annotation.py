@@ -48,18 +48,20 @@ class Annotator:
     def setExtensions():
         Span.set_extension("nameless_name", default=None)
 
-    def getSlicesForCoref(self, docs, max_len):
+    def getSlicesForCoref(self, docs, max_len, start=0):
         """
         Groups docs to slices with cumulative length of at most max_len (except when
         docs are long: at least one new doc and max_len/2 of previous docs are in
         one slice). A doc can be in multiple slices, it is done as a sliding window.
         
+        Docs before start are only used as the left context of the first slices.
+        
         Returns:
             [(start, end)]: List of tuples of docs indexes, these docs slices may
                             be merged for coreference resolution on a longer text.
         """
         slices = []
-        first_doc, last_doc = 0, 0
+        first_doc, last_doc = start, start
         current_len = 0
         
         while last_doc < len(docs):
@@ -89,19 +91,61 @@ class Annotator:
         
         docs = list(self.nlp.pipe(paragraphs))
         
-        coref_slices = self.getSlicesForCoref(docs, self.coref.MAX_LEN)
+        self.resolveCoreference(docs)
+        self.markNamelessCharacters(docs, self.findNamelessCharacters(docs))
+        self.markNarrator(docs)
+        
+        return docs
+    
+    
+    def annotateMore(self, docs, paragraphs, nameless_characters):
+        """
+        Annotates paragraphs appended to already annotated docs, e.g. a new
+        chapter of a serialized novel. Only the new paragraphs go through the
+        pipe; coreference is resolved on them with the tail of the previous
+        docs as context.
+        
+        Args:
+            nameless_characters: candidates of unnamed characters found so far
+                (see findNamelessCharacters), updated with the new docs
+        
+        Returns:
+            the new docs
+        """
+        new_docs = list(self.nlp.pipe(paragraphs))
+        all_docs = docs + new_docs
+        
+        self.resolveCoreference(all_docs, start=len(docs))
+        self.findNamelessCharacters(new_docs, nameless_characters, offset=len(docs))
+        self.markNamelessCharacters(all_docs, nameless_characters)
+        self.markNarrator(new_docs)
+        
+        return new_docs
+    
+    
+    def resolveCoreference(self, docs, start=0):
+        coref_slices = self.getSlicesForCoref(docs, self.coref.MAX_LEN, start)
         for (i, j) in tqdm(coref_slices, desc="Resolving coreference", unit="slice"):
             self.coref(docs[i:j])
+    
+    
+    def findNamelessCharacters(self, docs, nameless_characters=None, offset=0):
+        """
+        Finds nouns denoting persons that are subjects or objects of verbs
+        typical for characters (e.g. "the doctor said").
         
-        
-        nameless_characters = {}
+        Returns:
+            {text: ([(doc index, token index)], [noun chunk text])}
+        """
+        if nameless_characters == None:
+            nameless_characters = {}
         lemmatizer = WordNetLemmatizer()
-        for doc_i, doc in enumerate(docs):
+        for doc_i, doc in enumerate(docs, offset):
             for token in doc:
                 if token.pos_ == "VERB" and token.lemma_ in self.character_verb_predicates:
                     for child in token.children:
                         if child.pos_ == "NOUN" or child.pos_ == "PROPN" and child.dep_ in self.character_verb_predicates[token.lemma_]:
-                            if not (child.ent_iob_ == "B" or child.ent_iob_ == "I"):
+                            if not (child.ent_iob_ == "B" or child.ent_iob_ == "I") or child.ent_type_ == "NAMELESS_CHAR":
                                 singular = lemmatizer.lemmatize(child.lower_)
                                 if not singular == child.lower_:
                                     continue
@@ -115,28 +159,36 @@ class Annotator:
                                         nameless_characters[child.text][0].append(((doc_i, child.i)))
                                     else:
                                         nameless_characters[child.text] = ([(doc_i, child.i)], [])
-                                    chunk = None
                                     for ch in doc.noun_chunks:
                                         if ch.root == child:
-                                            nameless_characters[child.text][1].append(ch)
-                                    
+                                            nameless_characters[child.text][1].append(ch.text)
+        return nameless_characters
+    
+    
+    def markNamelessCharacters(self, docs, nameless_characters):
+        """
+        Marks the candidates described by the same noun chunk at least three
+        times as NAMELESS_CHAR entities. Tokens that are already entities are
+        left as they are.
+        """
         for nameless_id, (name, (occur_list, chunks)) in enumerate(nameless_characters.items()):
-            chunk = Counter([ch.text for ch in chunks]).most_common()
+            chunk = Counter(chunks).most_common()
             if chunk and chunk[0][1] >= 3:
                 for (doc_id, tok_id) in occur_list:
+                    if docs[doc_id][tok_id].ent_iob_ == "B" or docs[doc_id][tok_id].ent_iob_ == "I":
+                        continue
                     span = Span(docs[doc_id], tok_id, tok_id+1, "NAMELESS_CHAR")
                     docs[doc_id].set_ents(list(docs[doc_id].ents) + [span])
                     span._.nameless_name = chunk[0][0]
-            
-        
+    
+    
+    def markNarrator(self, docs):
         for doc in docs:
             for token in doc:
                 if token.lower_ in ['i', 'me', 'my'] and not token._.is_direct_speech:
                     if not (token.ent_iob_ == "B" or token.ent_iob_ == "I"):
                         span = Span(doc, token.i, token.i+1, "NARRATOR")
                         doc.set_ents(list(doc.ents) + [span])
-        
-        return docs
 
 
 class FalseAnnotator(Annotator):
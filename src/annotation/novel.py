@@ -0,0 +1,81 @@
+import numpy as np
+from spacy.attrs import IDX, POS, LEMMA, DEP, ENT_IOB, SENT_START
+
+
+class Novel:
+    """
+    Token annotations of all docs of a novel as NumPy columns, read by the
+    loops that go over every token: quote attribution and network creation.
+
+    Reading token._.char_id or token._.is_direct_speech goes through spaCy's
+    Underscore machinery for every token. The columns are read once from the
+    user_data of each doc instead, where the extensions store their values
+    under ('._.', name, token.idx, None), and the spaCy attributes are read
+    with Doc.to_array.
+
+    Columns, over the tokens of all docs one after another:
+
+        char_id             char_id of the token, NO_CHARACTER for None
+        is_direct_speech    bool
+        pos, lemma, dep     spaCy ids of the attributes
+        ent_iob             spaCy ent_iob ids
+        sent_start          1 for the first token of a sentence, -1 for the
+                            others, 0 when the doc has no sentences
+
+    The global position of token t of doc i is offsets[i] + t.
+
+    The columns are a copy: after the extensions are changed (e.g. the
+    characters are extracted again), update() must be called.
+    """
+    NO_CHARACTER = -2   # -1 is used as a char_id mark by the sieves
+
+    ATTRS = [('pos', POS), ('lemma', LEMMA), ('dep', DEP), ('ent_iob', ENT_IOB), ('sent_start', SENT_START)]
+    EXTENSIONS = [('char_id', np.int64, NO_CHARACTER), ('is_direct_speech', np.bool_, False)]
+
+    def __init__(self, docs):
+        self.docs = docs
+        self.doc_columns = dict((name, []) for name in [name for name, _ in Novel.ATTRS] + [name for name, _, _ in Novel.EXTENSIONS])
+        self.update()
+
+    def update(self, start=0):
+        """
+        Reads the columns of the docs from start on again, including docs
+        appended since the last update.
+        """
+        for name in self.doc_columns:
+            del self.doc_columns[name][start:]
+        for doc in self.docs[start:]:
+            for name, column in self.readDoc(doc).items():
+                self.doc_columns[name].append(column)
+
+        self.offsets = np.zeros(len(self.docs) + 1, dtype=np.int64)
+        np.cumsum([len(doc) for doc in self.docs], out=self.offsets[1:])
+        for name, columns in self.doc_columns.items():
+            dtype = columns[0].dtype if columns else np.int64
+            setattr(self, name, np.concatenate(columns) if columns else np.zeros(0, dtype=dtype))
+
+    def readDoc(self, doc):
+        attrs = doc.to_array([IDX] + [attr for _, attr in Novel.ATTRS]).reshape(len(doc), len(Novel.ATTRS) + 1)
+        columns = dict((name, attrs[:, k+1].copy()) for k, (name, _) in enumerate(Novel.ATTRS))
+
+        token_starts = attrs[:, 0]
+        for name, dtype, default in Novel.EXTENSIONS:
+            columns[name] = np.full(len(doc), default, dtype=dtype)
+        values = dict((name, ([], [])) for name, _, _ in Novel.EXTENSIONS)
+        for key, value in doc.user_data.items():
+            if len(key) == 4 and key[0] == '._.' and key[1] in values and key[3] == None and not key[2] == None:
+                if value == None:
+                    continue
+                values[key[1]][0].append(key[2])
+                values[key[1]][1].append(value)
+        for name, (starts, name_values) in values.items():
+            if starts:
+                columns[name][np.searchsorted(token_starts, starts)] = name_values
+        return columns
+
+    def column(self, name, i):
+        """
+        Returns:
+            the column of doc i (a view)
+        """
+        return getattr(self, name)[self.offsets[i]:self.offsets[i+1]]
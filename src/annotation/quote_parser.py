@@ -1,5 +1,7 @@
 import spacy
+import numpy as np
 from spacy import Language
+from spacy.attrs import IS_QUOTE
 from spacy.tokens import Doc, Span, Token
 
 
@@ -15,14 +17,15 @@ class QuoteParser:
     def setExtensions():
         Token.set_extension("is_direct_speech", default=False)
         Span.set_extension("is_direct_speech", getter=
-            lambda span: all([token._.is_direct_speech or token.is_quote for token in span]))
+            lambda span: countTokens(span, DIRECT_OR_QUOTE) == len(span))
         Span.set_extension("contains_direct_speech", getter=
-            lambda span: any([token._.is_direct_speech for token in span]))
+            lambda span: countTokens(span, DIRECT) > 0)
         Span.set_extension("contains_undirect_speech", getter=
-            lambda span: any([not token._.is_direct_speech and not (token.text == '"' or token.text == "'") for token in span]))
+            lambda span: countTokens(span, UNDIRECT) > 0)
         Doc.set_extension("contains_direct_speech", getter=
             lambda doc: doc[0:len(doc)]._.contains_direct_speech)
         Doc.set_extension("quotes", default=[])
+        Doc.set_extension("direct_speech_counts", default=None)
     
     def __call__(self, doc):
         doc = addDirectSpeechMarks(doc)
@@ -30,26 +33,75 @@ class QuoteParser:
         
 
 def addDirectSpeechMarks(doc):
+    """
+    Marks the tokens between quotation marks as direct speech and saves the
+    quotes as sorted (start, end) intervals including the marks. Only the
+    tokens with quotation marks are visited; the marks between them are
+    filled in as slices of a boolean mask.
+    """
+    texts = [token.text for token in doc]
+    is_direct_speech = np.zeros(len(doc), dtype=bool)
+    quotes = list(doc._.quotes)
+    
     is_direct = False
     current_quote_start = None
-    for token in doc:
-        token._.is_direct_speech = is_direct
-        if '"' in token.text:
+    previous = 0
+    for i in [k for k, text in enumerate(texts) if '"' in text or '“' in text or '”' in text]:
+        is_direct_speech[previous:i] = is_direct
+        previous = i + 1
+        if '"' in texts[i]:
             if current_quote_start == None:
-                current_quote_start = token.i
+                current_quote_start = i
             else:
-                doc._.quotes.append((current_quote_start, token.i+1))
+                quotes.append((current_quote_start, i+1))
                 current_quote_start = None
             is_direct = not is_direct
-            token._.is_direct_speech = False
-        elif '“' in token.text:
-            current_quote_start = token.i
+        elif '“' in texts[i]:
+            current_quote_start = i
             is_direct = True
-            token._.is_direct_speech = False
-        elif '”' in token.text:
+        elif '”' in texts[i]:
             if not current_quote_start == None:
-                doc._.quotes.append((current_quote_start, token.i+1))
+                quotes.append((current_quote_start, i+1))
             current_quote_start = None
             is_direct = False
-            token._.is_direct_speech = False
+    is_direct_speech[previous:] = is_direct
+    
+    for i in np.flatnonzero(is_direct_speech).tolist():
+        doc[i]._.is_direct_speech = True
+    doc._.quotes = quotes
+    doc._.direct_speech_counts = makeDirectSpeechCounts(doc, is_direct_speech)
     return doc
+
+
+# rows of Doc._.direct_speech_counts
+DIRECT = 0            # tokens of direct speech
+DIRECT_OR_QUOTE = 1   # tokens of direct speech or quotation marks
+UNDIRECT = 2          # tokens outside direct speech that are not " or '
+
+def makeDirectSpeechCounts(doc, is_direct_speech):
+    """
+    Returns:
+        (3, len(doc)+1) prefix sums of the token kinds, so that the number of
+        tokens of a kind in doc[start:end] is counts[kind, end] - counts[kind, start]
+    """
+    is_quote = doc.to_array(IS_QUOTE).reshape(len(doc)).astype(bool)
+    is_quote_text = np.array([token.text == '"' or token.text == "'" for token in doc], dtype=bool).reshape(len(doc))
+    counts = np.zeros((3, len(doc) + 1), dtype=np.int32)
+    np.cumsum(is_direct_speech, out=counts[DIRECT, 1:])
+    np.cumsum(is_direct_speech | is_quote, out=counts[DIRECT_OR_QUOTE, 1:])
+    np.cumsum(~is_direct_speech & ~is_quote_text, out=counts[UNDIRECT, 1:])
+    return counts
+
+
+def countTokens(span, kind):
+    """
+    Number of tokens of a kind in the span, in O(1). The counts of docs
+    annotated by older versions are computed on the first call.
+    """
+    doc = span.doc
+    counts = doc._.direct_speech_counts
+    if counts is None:
+        is_direct_speech = np.array([token._.is_direct_speech for token in doc], dtype=bool).reshape(len(doc))
+        counts = makeDirectSpeechCounts(doc, is_direct_speech)
+        doc._.direct_speech_counts = counts
+    return int(counts[kind, span.end] - counts[kind, span.start])
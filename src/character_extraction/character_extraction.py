@@ -7,12 +7,16 @@ from collections import Counter
 import matplotlib.pyplot as plt
 import spacy
 from spacy.tokens import Token, Span
+from spacy.lang.en import English
+from spacy.matcher import PhraseMatcher
 import os
 import json
 
 import character_extraction.name_parser as name_parser
 import character_extraction.name_unification_model as name_unification_model
 import character_extraction.name_unification_graph as name_unification_graph
+import character_extraction.union_find as union_find
+import character_extraction.feature_store as feature_store
 
 
 class CharacterExtractor:
@@ -46,32 +50,122 @@ class CharacterExtractor:
         
     
     
-    def extractCharacters(self, model_path="name_unification.model", edge_maxprob=0.9, character_remove_limit=3):
+    def extractCharacters(self, model_path="name_unification.model", edge_maxprob=0.9, character_remove_limit=3, registry=None, shortest_paths=True):
         """
         Extracts and merges characters.
         
         When finished, character clusters are available in self.characters
+        
+        Conflicting names are separated along shortest paths, or with the
+        faster maximum spanning tree cut if shortest_paths is False (see
+        removeNodes).
+        
+        If a CharacterRegistry of a series is given, names of characters known
+        from previous stories are matched to them without the model, and the
+        registry is updated with the characters of this story.
         """
         logging.info("Begin extracting characters...")
         
-        G = name_unification_graph.CharacterUnificationGraph(self.docs, self.clusters).createGraph()
+        G = name_unification_graph.CharacterUnificationGraph(self.docs, self.clusters, registry).createGraph()
         
         edge_prediction = self.predictProba(G, model_path)
+        if registry:
+            edge_prediction.update(registry.knownPairs(G.nodes))
         final_graph = self.initFinalGraph(G, edge_prediction)
-        final_graph = self.removeNodes(final_graph, G, edge_prediction, edge_maxprob, character_remove_limit)
+        final_graph = self.removeNodes(final_graph, G, edge_prediction, edge_maxprob, character_remove_limit, shortest_paths)
         final_graph, G = self.renameNodes(final_graph, G, edge_prediction)
         self.final_graph = final_graph
         self.G = G
         
         self.characters = self.makeCharacters(final_graph, G)
         
+        if registry:
+            for char_id, (variants, gender) in self.characters.items():
+                registry_id = registry.findCharacter(variants)
+                if not registry_id == None:
+                    self.characters[char_id] = (variants, registry.gender(registry_id, variants, gender))
+        
         self.markCharactersInCoref(self.characters)
         
+        if registry:
+            self.registry_ids = registry.update(self.characters, G)
+        
         logging.info("Characters extracted.")
         
         return self.characters
     
     
+    def extractCharacterSettings(self, model_path="name_unification.model", settings=[(0.9, 3)], shortest_paths=True):
+        """
+        Extracts characters for several settings of edge_maxprob and
+        character_remove_limit at once, e.g. to tune them on a grid.
+        
+        The graph and the edge probabilities are computed once, and conflicts
+        are cut once per edge_maxprob; each character_remove_limit only
+        filters the resulting components. With the spanning tree cut
+        (shortest_paths=False), edges are also sorted once and the edges
+        that can never be cut are merged incrementally from the highest
+        edge_maxprob down.
+        
+        Each result is the same as extractCharacters gives for that setting,
+        but the characters are not marked in the docs and self.characters,
+        self.G and self.final_graph are left untouched.
+        
+        Args:
+            settings: list of (edge_maxprob, character_remove_limit)
+        
+        Returns:
+            {(edge_maxprob, character_remove_limit): characters}
+        """
+        logging.info("Begin extracting characters for {} settings...".format(len(settings)))
+        
+        G = name_unification_graph.CharacterUnificationGraph(self.docs, self.clusters).createGraph()
+        edge_prediction = self.predictProba(G, model_path)
+        final_graph = self.initFinalGraph(G, edge_prediction)
+        
+        node_graph = nx.Graph()
+        node_graph.add_nodes_from(G.nodes(data=True))
+        
+        remove_limits = {}
+        for edge_maxprob, character_remove_limit in settings:
+            remove_limits.setdefault(edge_maxprob, []).append(character_remove_limit)
+        
+        if not shortest_paths:
+            conflicts = self.findConflicts(final_graph, edge_prediction)
+            edges = self.sortEdges(final_graph)
+            forced_sets = union_find.UnionFind(final_graph.nodes)
+            forced = 0
+        
+        all_characters = {}
+        for edge_maxprob in sorted(remove_limits, reverse=True):
+            if shortest_paths:
+                cut_graph = self.cutConflictsShortestPaths(final_graph.copy(), edge_prediction, edge_maxprob)
+                components = list(nx.connected_components(cut_graph))
+            else:
+                while forced < len(edges) and edges[forced][2] >= edge_maxprob:
+                    forced_sets.union(edges[forced][0], edges[forced][1])
+                    forced += 1
+                sets = forced_sets.copy()
+                cut_graph = final_graph.copy()
+                cut_graph.remove_edges_from(self.spanningTreeCut(sets, edges[forced:], conflicts))
+                components = sets.sets()
+            
+            for character_remove_limit in remove_limits[edge_maxprob]:
+                nodes_to_remove = []
+                for c in components:
+                    if sum(G.nodes[node]['occurences'] for node in c) < character_remove_limit:
+                        nodes_to_remove += list(c)
+                setting_graph = cut_graph.copy()
+                setting_graph.remove_nodes_from(nodes_to_remove)
+                
+                setting_graph, setting_G = self.renameNodes(setting_graph, node_graph.copy(), edge_prediction)
+                all_characters[(edge_maxprob, character_remove_limit)] = self.makeCharacters(setting_graph, setting_G)
+        
+        logging.info("Characters extracted.")
+        
+        return all_characters
+    
+    
     def reconstructClusters(self):
         mindoc, maxdoc = 0, 0
         clusters = []
@@ -94,13 +188,14 @@ class CharacterExtractor:
     
     
         
-    def saveWeights(self, out_file):
+    def saveFeatures(self, book):
+        """
+        Saves the pair features to the feature store <book>.features, with
+        labels if the golden characters <book>.csv are available.
+        """
         G = name_unification_graph.CharacterUnificationGraph(self.docs, self.clusters).createGraph()
-        with open(out_file, 'w') as f:
-            for edge in self.graphToList(G):
-                f.write(','.join([str(num) for num in edge]) + '\n')
+        feature_store.saveGraph(G, feature_store.storePath(book), book + '.csv')
         
-    
     def graphToList(self, G):
         """
         For each edge, returns weights to predict if the nodes
@@ -118,7 +213,7 @@ class CharacterExtractor:
         
         prediction = model.predict_proba([w[2:] for w in weights])
         
-        edge_prediction = dict((zip([(w[0], w[1]) for w in weights], [p[1] for p in prediction])))
+        edge_prediction = dict((zip([(w[0], w[1]) for w in weights], prediction[:, 1].tolist())))
         
         return edge_prediction
 
@@ -127,12 +222,122 @@ class CharacterExtractor:
         final_graph.add_nodes_from(G.nodes)
         
         for (u, v), prob in edge_prediction.items():
-            G[u][v]['prob'] = prob
+            if G.has_edge(u, v):
+                G[u][v]['prob'] = prob
             if prob > 0.5:
                 final_graph.add_edge(u, v, prob=prob)
         return final_graph
     
-    def removeNodes(self, final_graph, G, edge_prediction, edge_maxprob, character_remove_limit):
+    def removeNodes(self, final_graph, G, edge_prediction, edge_maxprob, character_remove_limit, shortest_paths=True):
+        """
+        Separates conflicting names and removes characters with less than
+        character_remove_limit occurences.
+        
+        The spanning tree cut (shortest_paths=False) visits every edge once
+        instead of searching a path per conflict, but it can cut differently;
+        compare both with `evaluate cuts` before using it.
+        """
+        if shortest_paths:
+            self.cutConflictsShortestPaths(final_graph, edge_prediction, edge_maxprob)
+        else:
+            self.cutConflictsSpanningTree(final_graph, edge_prediction, edge_maxprob)
+        
+        nodes_to_remove = []
+        for c in (nx.connected_components(final_graph)):
+            occurences = 0
+            for node in c:
+                occurences += G.nodes[node]['occurences']
+            if occurences < character_remove_limit:
+                nodes_to_remove += list(c)
+        final_graph.remove_nodes_from(nodes_to_remove)
+        return final_graph
+    
+    def cutConflictsSpanningTree(self, final_graph, edge_prediction, edge_maxprob):
+        """
+        Separates pairs of names with probability < 0.1 that ended up in the
+        same component.
+        
+        Builds a maximum spanning forest of final_graph with Kruskal's algorithm
+        and cannot-link constraints: edges are added from the most probable one
+        and an edge is cut if it would join two sets containing a conflicting
+        pair. Edges with probability >= edge_maxprob are never cut, so conflicts
+        joined by them are left as they are.
+        
+        Every edge is visited once, no paths are searched.
+        """
+        conflicts = self.findConflicts(final_graph, edge_prediction)
+        if not conflicts:
+            return final_graph
+        
+        edges = self.sortEdges(final_graph)
+        sets = union_find.UnionFind(final_graph.nodes)
+        forced = 0
+        while forced < len(edges) and edges[forced][2] >= edge_maxprob:
+            sets.union(edges[forced][0], edges[forced][1])
+            forced += 1
+        
+        final_graph.remove_edges_from(self.spanningTreeCut(sets, edges[forced:], conflicts))
+        return final_graph
+    
+    def findConflicts(self, final_graph, edge_prediction):
+        """
+        Returns pairs of names with probability < 0.1 in one component of final_graph.
+        """
+        components = union_find.UnionFind(final_graph.nodes)
+        for u, v in final_graph.edges:
+            components.union(u, v)
+        
+        conflicts = []
+        for (name_A, name_B), prob in edge_prediction.items():
+            if prob < 0.1 and components.find(name_A) == components.find(name_B):
+                conflicts.append((name_A, name_B))
+        return conflicts
+    
+    def sortEdges(self, final_graph):
+        """
+        Edges of final_graph as (u, v, prob), the most probable first.
+        """
+        return sorted(final_graph.edges.data('prob'), key=lambda t: t[2], reverse=True)
+    
+    def spanningTreeCut(self, sets, edges, conflicts):
+        """
+        Adds the sorted edges to the union-find sets unless they would join
+        a conflicting pair.
+        
+        Returns:
+            [(u, v)]: the edges that were cut
+        """
+        # cannot-link sets, kept for the current root of each set only
+        cannot_link = {}
+        for name_A, name_B in conflicts:
+            root_A, root_B = sets.find(name_A), sets.find(name_B)
+            if root_A == root_B:
+                continue
+            cannot_link.setdefault(root_A, set()).add(root_B)
+            cannot_link.setdefault(root_B, set()).add(root_A)
+        
+        edges_to_remove = []
+        for u, v, prob in edges:
+            root_u, root_v = sets.find(u), sets.find(v)
+            if root_u == root_v:
+                continue
+            if root_v in cannot_link.get(root_u, ()):
+                edges_to_remove.append((u, v))
+                continue
+            root, merged = sets.union(u, v)
+            merged_links = cannot_link.pop(merged, set())
+            for other in merged_links:
+                cannot_link[other].discard(merged)
+                cannot_link[other].add(root)
+            if merged_links:
+                cannot_link.setdefault(root, set()).update(merged_links)
+        return edges_to_remove
+    
+    def cutConflictsShortestPaths(self, final_graph, edge_prediction, edge_maxprob):
+        """
+        The default cutting of conflicting pairs: for each pair with probability
+        < 0.1, removes the least probable edge on the shortest path between them.
+        """
         for c in (nx.connected_components(final_graph)):
             if len(c) > 2:
                 sorted_toremove = []
@@ -158,15 +363,6 @@ class CharacterExtractor:
                     if i == None:
                         continue
                     final_graph.remove_edge(path[i], path[i+1])
-        
-        nodes_to_remove = []
-        for c in (nx.connected_components(final_graph)):
-            occurences = 0
-            for node in c:
-                occurences += G.nodes[node]['occurences']
-            if occurences < character_remove_limit:
-                nodes_to_remove += list(c)
-        final_graph.remove_nodes_from(nodes_to_remove)
         return final_graph
 
     def renameNodes(self, final_graph, G, edge_prediction):
@@ -201,7 +397,7 @@ class CharacterExtractor:
     
     
     def makeCharacters(self, final_graph, G):
-        self.characters = {}
+        characters = {}
         char_id = 0
         for c in (nx.connected_components(final_graph)):
             variants = []
@@ -221,10 +417,10 @@ class CharacterExtractor:
                 else:
                     final_gender_m += occurences
             final_gender = 'F' if final_gender_f > final_gender_m else 'M'
-            self.characters[char_id] = (variants, final_gender)
+            characters[char_id] = (variants, final_gender)
             char_id += 1
         
-        return self.characters
+        return characters
         
     
     def markCharactersInCoref(self, characters):
@@ -290,15 +486,39 @@ class CharacterExtractor:
                     pass
                     
                 
+        matcher, match_ids = self.makeNameMatcher(name_dict)
         for doc in self.docs:
-            for ent in doc.ents:
-                if ent.text in name_dict:
-                    ent.root._.char_id = (name_dict[ent.text][0])
+            matches = matcher(doc)
+            # longer names first, so that single-token matches overwrite them
+            matches.sort(key=lambda m: m[2] - m[1], reverse=True)
+            for match_id, start, end in matches:
+                doc[start:end].root._.char_id = match_ids[match_id]
+    
+    def makeNameMatcher(self, name_dict):
+        """
+        Builds a PhraseMatcher of all character name variants, tokenized the
+        same way as the docs, so that multi-token names are found too.
         
-        for doc in self.docs:
-            for token in doc:
-                if token.text in name_dict:
-                    token._.char_id = (name_dict[token.text][0])
+        Returns:
+            (matcher, {match_id: char_id})
+        """
+        vocab = self.docs[0].vocab
+        nlp = English(vocab=vocab)
+        matcher = PhraseMatcher(vocab)
+        
+        patterns = {}
+        for name, (char_id, gender) in name_dict.items():
+            if char_id in patterns:
+                patterns[char_id].append(nlp.make_doc(name))
+            else:
+                patterns[char_id] = [nlp.make_doc(name)]
+        
+        match_ids = {}
+        for char_id, name_docs in patterns.items():
+            key = "CHARACTER_{}".format(char_id)
+            matcher.add(key, name_docs)
+            match_ids[vocab.strings[key]] = char_id
+        return matcher, match_ids
 
     def setExtensions():
         if not Token.has_extension("char_id"):
@@ -318,7 +538,7 @@ class FalseCharacterExtractor(CharacterExtractor):
         for char_id, (names, gender) in characters.items():
             for (name, count) in names:
                 self.character_names[name] = char_id
-    def extractCharacters(self, model=None, edge_maxprob=None, character_remove_limit=None):
+    def extractCharacters(self, model=None, edge_maxprob=None, character_remove_limit=None, registry=None, shortest_paths=None):
         self.reconstructClusters()
         self.markCharactersInCoref(self.false_characters)
         return self.false_characters
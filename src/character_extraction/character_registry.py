@@ -0,0 +1,119 @@
+import os
+import json
+import logging
+from collections import Counter
+
+import character_extraction.name_parser as name_parser
+
+
+class CharacterRegistry:
+    """
+    Characters recurring in a series of stories (e.g. Holmes, Watson and
+    Lestrade in the Sherlock Holmes stories), saved between runs.
+    
+    For every known character the registry keeps its name variants with
+    occurence counts and the gender evidence, and for every name its parsed
+    Person. Names found in the registry are not parsed again, and pairs of
+    known names are not compared again: names of the same known character
+    are merged and names of different known characters are kept apart.
+    Only pairs with at least one new name go through the model.
+    """
+    def __init__(self):
+        self.characters = []    # [{'variants': {name: count}, 'female': int, 'male': int, 'stories': int}]
+        self.name_ids = {}      # name -> index to self.characters
+        self.persons = {}       # name -> Person
+    
+    def load(registry_file):
+        registry = CharacterRegistry()
+        if not os.path.exists(registry_file):
+            logging.info("Registry {} not found, starting a new one.".format(registry_file))
+            return registry
+        with open(registry_file) as f:
+            data = json.load(f)
+        registry.characters = data['characters']
+        for registry_id, character in enumerate(registry.characters):
+            for name in character['variants']:
+                registry.name_ids[name] = registry_id
+        for name, (gender, honorific, first_name, last_name, name_variants) in data['persons'].items():
+            registry.persons[name] = name_parser.Person(gender, honorific, first_name, last_name, name_variants)
+        logging.info("Registry loaded with {} characters.".format(len(registry.characters)))
+        return registry
+    
+    def save(self, registry_file):
+        persons = {}
+        for name, person in self.persons.items():
+            persons[name] = [person.gender, person.honorific, person.first_name, person.last_name, person.name_variants]
+        with open(registry_file, 'w') as f:
+            json.dump({'characters': self.characters, 'persons': persons}, f, indent=1)
+        logging.info("Registry saved to {}".format(registry_file))
+    
+    def knownPairs(self, names):
+        """
+        Returns probabilities for all pairs of known names among names:
+        1 if they belong to the same character, 0 otherwise.
+        """
+        known = [name for name in names if name in self.name_ids]
+        pairs = {}
+        for i, name_A in enumerate(known):
+            for name_B in known[i+1:]:
+                pairs[(name_A, name_B)] = 1.0 if self.name_ids[name_A] == self.name_ids[name_B] else 0.0
+        return pairs
+    
+    def findCharacter(self, variants):
+        """
+        Returns the registry id of the known character with the most
+        occurences among the variants, or None.
+        """
+        ids = Counter()
+        for name, count in variants:
+            if name in self.name_ids:
+                ids[self.name_ids[name]] += count + 1
+        if not ids:
+            return None
+        return ids.most_common(1)[0][0]
+    
+    def gender(self, registry_id, variants, gender):
+        """
+        Combines the gender inferred in the current story with the evidence
+        from the previous ones.
+        """
+        character = self.characters[registry_id]
+        count = sum(c for name, c in variants)
+        female = character['female'] + (count if gender == 'F' else 0)
+        male = character['male'] + (count if gender == 'M' else 0)
+        return 'F' if female > male else 'M'
+    
+    def update(self, characters, G):
+        """
+        Adds the characters of a processed story: new names of known characters
+        are added to them, characters with no known name are added as new.
+        Only names of persons are registered, not the narrator or unnamed characters.
+        
+        Returns:
+            {char_id: registry_id}
+        """
+        registry_ids = {}
+        for char_id, (variants, gender) in characters.items():
+            persons = [(name, count) for name, count in variants if name in G.nodes and G.nodes[name]['type'] == "PERSON"]
+            if not persons:
+                continue
+            registry_id = self.findCharacter(persons)
+            if registry_id == None:
+                registry_id = len(self.characters)
+                self.characters.append({'variants': {}, 'female': 0, 'male': 0, 'stories': 0})
+            
+            character = self.characters[registry_id]
+            character['stories'] += 1
+            for name, count in persons:
+                if name in self.name_ids and not self.name_ids[name] == registry_id:
+                    continue
+                self.name_ids[name] = registry_id
+                character['variants'][name] = character['variants'].get(name, 0) + count
+                if not name in self.persons:
+                    self.persons[name] = G.nodes[name]['person']
+                if gender == 'F':
+                    character['female'] += count
+                else:
+                    character['male'] += count
+            registry_ids[char_id] = registry_id
+        return registry_ids
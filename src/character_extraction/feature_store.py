@@ -0,0 +1,137 @@
+"""
+Binary storage of the pair features of a book, used to train the name
+unification model. A book is stored in a directory <book>.features with
+    
+    names.npy       interned table of the names in the book
+    pairs.npy       (n, 2) indexes of both names of each pair to names.npy
+    features.npy    (n, k) features of each pair (edge data of the graph)
+    labels.npy      (n,) 1 if both names are the same character, 0 if not,
+                    -1 if a name is not in the golden characters; created
+                    from <book>.csv when it is available and recreated when
+                    the csv is newer
+
+All arrays are plain .npy files, so they are loaded with no parsing and can
+be memory mapped.
+"""
+
+import os
+import shutil
+import logging
+
+import numpy as np
+
+STORE_EXT = '.features'
+
+
+def storePath(book):
+    return book + STORE_EXT
+
+
+def saveGraph(G, store_dir, gold_file=None):
+    """
+    Saves the features of all edges of the character unification graph.
+    """
+    names = list(G.nodes)
+    index = dict((name, i) for i, name in enumerate(names))
+    pairs = np.array([(index[u], index[v]) for u, v in G.edges], dtype=np.int32).reshape(-1, 2)
+    features = [[int(data[key]) for key in data] for u, v, data in G.edges(data=True)]
+    n_features = len(features[0]) if features else 0
+    features = np.array(features, dtype=np.int32).reshape(len(pairs), n_features)
+    saveArrays(store_dir, names, pairs, features)
+    if gold_file and os.path.exists(gold_file):
+        getLabels(store_dir, gold_file)
+
+
+def saveArrays(store_dir, names, pairs, features):
+    """
+    Writes the store to a temporary directory first and renames it, so that
+    an interrupted collect never leaves a partial store behind.
+    """
+    tmp_dir = store_dir + '.tmp{}'.format(os.getpid())
+    if os.path.exists(tmp_dir):
+        shutil.rmtree(tmp_dir)
+    os.makedirs(tmp_dir)
+    np.save(os.path.join(tmp_dir, 'names.npy'), np.array(names, dtype=str))
+    np.save(os.path.join(tmp_dir, 'pairs.npy'), pairs)
+    np.save(os.path.join(tmp_dir, 'features.npy'), features)
+    if os.path.exists(store_dir):
+        shutil.rmtree(store_dir)
+    os.rename(tmp_dir, store_dir)
+
+
+def convertWeights(book):
+    """
+    Converts <book>.weights written by older versions of collect to
+    <book>.features. An empty file (a book with less than two names) is
+    not converted.
+    
+    Returns:
+        True if the store was written
+    """
+    names = []
+    index = {}
+    pairs = []
+    features = []
+    with open(book + '.weights') as f:
+        for line in f.read().splitlines():
+            parts = line.split(',')
+            for name in parts[:2]:
+                if not name in index:
+                    index[name] = len(names)
+                    names.append(name)
+            pairs.append((index[parts[0]], index[parts[1]]))
+            features.append([int(n) for n in parts[2:]])
+    if not features:
+        logging.warning("No pairs in {}, skipping it.".format(book + '.weights'))
+        return False
+    pairs = np.array(pairs, dtype=np.int32)
+    features = np.array(features, dtype=np.int32)
+    saveArrays(storePath(book), names, pairs, features)
+    logging.info("Converted {} to {}".format(book + '.weights', storePath(book)))
+    return True
+
+
+def getLabels(store_dir, gold_file):
+    """
+    Returns the labels of the pairs, computing them from the golden
+    characters (csv with a header, columns character id, name) and saving
+    them. The saved labels are used until the csv is modified.
+    
+    Raises:
+        FileNotFoundError: if there are no saved labels and no gold_file
+    """
+    labels_file = os.path.join(store_dir, 'labels.npy')
+    if os.path.exists(labels_file) and (gold_file == None or os.path.getmtime(labels_file) >= os.path.getmtime(gold_file)):
+        return np.load(labels_file, mmap_mode='r')
+    if gold_file == None:
+        raise FileNotFoundError("The book {} has no labels and no golden characters to compute them from".format(store_dir))
+    
+    characters = {}
+    with open(gold_file) as f:
+        for line in f.read().splitlines()[1:]:
+            parts = line.split(',')
+            characters[parts[1]] = int(parts[0])
+    
+    names = np.load(os.path.join(store_dir, 'names.npy'))
+    pairs = np.load(os.path.join(store_dir, 'pairs.npy'))
+    is_gold = np.array([name in characters for name in names.tolist()])
+    gold_ids = np.array([characters.get(name, 0) for name in names.tolist()], dtype=np.int64)
+    labels = (gold_ids[pairs[:, 0]] == gold_ids[pairs[:, 1]]).astype(np.int8)
+    labels[~(is_gold[pairs[:, 0]] & is_gold[pairs[:, 1]])] = -1
+    with open(labels_file + '.tmp{}'.format(os.getpid()), 'wb') as f:
+        np.save(f, labels)
+    os.replace(labels_file + '.tmp{}'.format(os.getpid()), labels_file)
+    return labels
+
+
+def countPairs(store_dir):
+    return len(np.load(os.path.join(store_dir, 'pairs.npy'), mmap_mode='r'))
+
+
+def loadBook(store_dir, gold_file=None):
+    """
+    Returns the memory mapped features and labels of a book.
+    """
+    features = np.load(os.path.join(store_dir, 'features.npy'), mmap_mode='r')
+    labels = getLabels(store_dir, gold_file)
+    return features, labels
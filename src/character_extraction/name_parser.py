@@ -46,8 +46,15 @@ class Person:
 
 
 class NameParser:
-    def __init__(self, names):
+    def __init__(self, names, known_persons={}):
+        """
+        Args:
+            names: list of names to parse
+            known_persons: dict name -> Person parsed before (e.g. in previous
+                stories), used only to recognize first and last names
+        """
         self.names = names
+        self.known_persons = known_persons
         vocab_dir = os.path.join(os.path.dirname(__file__), '..', '..', 'vocab')
         
         with open(os.path.join(vocab_dir, 'honorific.json')) as honorific_file:
@@ -80,6 +87,10 @@ class NameParser:
                 _, first_name, last_name = self.parseName(full_name)
                 self.first_names.add(first_name)
                 self.last_names.add(last_name)
+        for person in self.known_persons.values():
+            if person.first_name and person.last_name:
+                self.first_names.add(person.first_name)
+                self.last_names.add(person.last_name)
         return
     
     def parseNames(self):
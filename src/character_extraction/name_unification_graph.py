@@ -5,19 +5,30 @@ import string
 import character_extraction.name_parser as name_parser
 
 class CharacterUnificationGraph:
-    def __init__(self, docs, clusters):
+    def __init__(self, docs, clusters, registry=None):
+        """
+        Args:
+            registry: optional CharacterRegistry of characters known from
+                previous stories; pairs of known names get no edge
+        """
         self.docs = docs
         self.G = nx.Graph()
         self.clusters = clusters
+        self.known_names = registry.name_ids if registry else {}
+        self.known_persons = registry.persons if registry else {}
 
 
     def createGraph(self):
         self.addNodes()
-        parser = name_parser.NameParser([name for (name, data) in self.G.nodes(data=True) if data['type'] == 'PERSON'])
+        person_names = [name for (name, data) in self.G.nodes(data=True) if data['type'] == 'PERSON']
+        parser = name_parser.NameParser([name for name in person_names if not name in self.known_persons], self.known_persons)
         name_dict = parser.parseNames()
         for name, data in self.G.nodes(data=True):
             if data['type'] == 'PERSON':
-                data['person'] = name_dict[name]
+                if name in self.known_persons:
+                    data['person'] = self.known_persons[name]
+                else:
+                    data['person'] = name_dict[name]
         
         edge_dict = {
             'coref_connected'     : 0,
@@ -33,6 +44,8 @@ class CharacterUnificationGraph:
         }
         for node_A in self.G.nodes(data=False):
             for node_B in self.G.nodes(data=False):
+                if self.isKnownPair(node_A, node_B):
+                    continue
                 if not node_A == node_B and not (node_A, node_B) in self.G.edges:
                     self.G.add_edge(node_A, node_B)
                     for key in edge_dict:
@@ -93,8 +106,12 @@ class CharacterUnificationGraph:
             self.G.nodes[ent.text]['occurences'] += 1
     
     
+    def isKnownPair(self, node1, node2):
+        return node1 in self.known_names and node2 in self.known_names
+    
+    
     def addEdge(self, node1, node2, edge_type):
-        if node1 == node2:
+        if node1 == node2 or self.isKnownPair(node1, node2):
             return
         
         self.G[node1][node2][edge_type] += 1
@@ -157,6 +174,8 @@ class CharacterUnificationGraph:
         # both pairs appear twice but it in fact does not matter
         for node_A, data_A in self.G.nodes(data=True):
             for node_B, data_B in self.G.nodes(data=True):
+                if self.isKnownPair(node_A, node_B):
+                    continue
                 if data_A['type'] == 'PERSON' and data_B['type'] == 'PERSON':
                     person_A = data_A['person']
                     person_B = data_B['person']
@@ -208,6 +227,8 @@ class CharacterUnificationGraph:
         # both pairs appear twice but in fact it does not matter
         for node_A, data_A in self.G.nodes(data=True):
             for node_B, data_B in self.G.nodes(data=True):
+                if self.isKnownPair(node_A, node_B):
+                    continue
                 person_A = data_A['person'] if data_A['type'] == 'PERSON' else None
                 genders_A = getGenders(data_A['female_coref'], data_A['male_coref'], person_A)
                 
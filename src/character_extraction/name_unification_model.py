@@ -4,77 +4,454 @@ import pickle
 import lzma
 import os
 import logging
+import multiprocessing
+import time
 
 import numpy as np
-import sklearn
-import sklearn.datasets
-import sklearn.linear_model
-import sklearn.metrics
-import sklearn.model_selection
-from sklearn.neural_network import MLPClassifier
+
+import character_extraction.feature_store as feature_store
 
 model_file = "name_unification.model"
 
+# models already loaded in this process: model path -> (loaded file, its mtime, model)
+_model_registry = {}
+
+
+class NumpyMLP:
+    """
+    Forward pass of a trained sklearn MLPClassifier using only NumPy.
+    
+    The weights are exported from the pickled model by exportModel, so that
+    character extraction does not need to import sklearn at all.
+    """
+    def __init__(self, coefs, intercepts, activation, out_activation, classes):
+        self.coefs = [np.asarray(c, dtype=np.float64) for c in coefs]
+        self.intercepts = [np.asarray(b, dtype=np.float64) for b in intercepts]
+        self.activation = activation
+        self.out_activation = out_activation
+        self.classes = np.asarray(classes)
+    
+    def fromSklearn(model):
+        return NumpyMLP(model.coefs_, model.intercepts_, model.activation, model.out_activation_, model.classes_)
+    
+    def load(npz_file):
+        with np.load(npz_file, allow_pickle=False) as data:
+            n_layers = int(data['n_layers'])
+            coefs = [data['coef_{}'.format(i)] for i in range(n_layers)]
+            intercepts = [data['intercept_{}'.format(i)] for i in range(n_layers)]
+            return NumpyMLP(coefs, intercepts, str(data['activation']), str(data['out_activation']), data['classes'])
+    
+    def save(self, npz_file):
+        arrays = {
+            'n_layers'       : np.array(len(self.coefs)),
+            'activation'     : np.array(self.activation),
+            'out_activation' : np.array(self.out_activation),
+            'classes'        : self.classes
+        }
+        for i, (coef, intercept) in enumerate(zip(self.coefs, self.intercepts)):
+            arrays['coef_{}'.format(i)] = coef
+            arrays['intercept_{}'.format(i)] = intercept
+        with open(npz_file, 'wb') as f:
+            np.savez_compressed(f, **arrays)
+    
+    def activate(self, X, activation):
+        if activation == 'relu':
+            return np.maximum(X, 0, out=X)
+        elif activation == 'tanh':
+            return np.tanh(X, out=X)
+        elif activation == 'logistic':
+            return 1 / (1 + np.exp(-X))
+        elif activation == 'identity':
+            return X
+        elif activation == 'softmax':
+            X = np.exp(X - X.max(axis=1, keepdims=True))
+            return X / X.sum(axis=1, keepdims=True)
+        raise Exception("Unknown activation function '{}'!".format(activation))
+    
+    def forward(self, X):
+        for layer, (coef, intercept) in enumerate(zip(self.coefs, self.intercepts)):
+            X = X @ coef + intercept
+            if layer < len(self.coefs) - 1:
+                X = self.activate(X, self.activation)
+        return self.activate(X, self.out_activation)
+    
+    def predict_proba(self, X, batch_size=4096):
+        """
+        Same output as MLPClassifier.predict_proba, computed in batches of
+        batch_size rows so that the hidden layer activations of the whole
+        pair-feature matrix are never in memory at once.
+        """
+        X = np.asarray(X, dtype=np.float64)
+        n_classes = max(len(self.classes), 2)
+        if X.size == 0:
+            return np.zeros((0, n_classes))
+        X = X.reshape(len(X), -1)
+        
+        proba = np.empty((len(X), n_classes))
+        for start in range(0, len(X), batch_size):
+            out = self.forward(X[start:start+batch_size])
+            if out.shape[1] == 1:
+                out = out.ravel()
+                proba[start:start+batch_size, 0] = 1 - out
+                proba[start:start+batch_size, 1] = out
+            else:
+                proba[start:start+batch_size] = out
+        return proba
+
+
+def exportedPath(model_path):
+    return os.path.splitext(model_path)[0] + '.npz'
+
+
 def getModel(model_path):
+    """
+    Returns the model saved at model_path, loading it only once per process
+    unless the file was rewritten since (e.g. by trainModel or exportModel).
+    
+    If the weights were exported next to the model (see exportModel), they
+    are used instead of unpickling the sklearn model. Weights older than the
+    model are exported again, or the model is unpickled if they cannot be
+    written.
+    """
+    if model_path.endswith('.npz'):
+        source = model_path
+    elif os.path.exists(exportedPath(model_path)):
+        source = exportedPath(model_path)
+        if os.path.getmtime(source) < os.path.getmtime(model_path):
+            logging.warning("The exported weights {} are older than {}, exporting them again.".format(source, model_path))
+            try:
+                exportModel(model_path)
+            except OSError as e:
+                logging.warning("Could not export the weights ({}), unpickling the sklearn model.".format(e))
+                source = model_path
+    else:
+        source = model_path
+    mtime = os.path.getmtime(source)
+    
+    if model_path in _model_registry:
+        cached_source, cached_mtime, model = _model_registry[model_path]
+        if cached_source == source and cached_mtime == mtime:
+            return model
+    
+    if source == model_path and not model_path.endswith('.npz'):
+        if not os.path.exists(exportedPath(model_path)):
+            logging.warning("No exported weights found for {}, unpickling the sklearn model.".format(model_path))
+        model = NumpyMLP.fromSklearn(loadSklearnModel(model_path))
+    else:
+        model = NumpyMLP.load(source)
+    
+    _model_registry[model_path] = (source, mtime, model)
+    return model
+
+
+def loadSklearnModel(model_path):
     with lzma.open(model_path, "rb") as f:
         model = pickle.load(f)
         return model
 
 
-def trainModel(data_path, out_file=model_file, random_state=13):
-    train_data, train_target = getTrainData(data_path)
+def exportModel(model_path, out_file=None):
+    """
+    Writes the weights of the pickled MLPClassifier to a .npz file
+    (by default next to the model) for the NumPy-only inference.
+    """
+    out_file = out_file or exportedPath(model_path)
+    NumpyMLP.fromSklearn(loadSklearnModel(model_path)).save(out_file)
+    logging.info("Model weights exported to {}".format(out_file))
+    return out_file
+
+
+def trainModel(data_path, out_file=model_file, random_state=13, stream=False, negative_ratio=0.1, batch_size=200, epochs=20):
+    """
+    Trains the model on all pairs of golden characters in data_path, or with
+    stream=True on minibatches streamed book by book with subsampled easy
+    negatives (see trainStreaming).
+    """
+    from sklearn.neural_network import MLPClassifier
     
-    logging.info("Training the model...")
-    model = MLPClassifier(random_state=random_state)
-    model.fit(train_data, train_target)
+    if stream:
+        logging.info("Training the model on streamed minibatches...")
+        model = trainStreaming(findBooks(data_path), negative_ratio, batch_size, epochs, random_state)
+    else:
+        train_data, train_target = getTrainData(data_path)
+        
+        logging.info("Training the model...")
+        model = MLPClassifier(random_state=random_state)
+        model.fit(train_data, train_target)
     logging.info("Model trained.")
     
     with lzma.open(out_file, "wb") as f:
         pickle.dump(model, f)
-        
+    
     logging.info("Model saved to {}".format(out_file))
     
+    exportModel(out_file)
+    
     return model
 
 
-def getTrainData(data_path):
-    logging.info('Getting training data from {}...'.format(data_path))
-    
+def findBooks(data_path):
+    """
+    Returns the paths (without extension) of all books in data_path with
+    collected pair features. Books with only the older .weights files are
+    converted to feature stores first, books with no pairs are skipped.
+    """
     books = []
     for root, dirs, files in os.walk(data_path):
+        stores = [d for d in dirs if d.endswith(feature_store.STORE_EXT)]
+        for store in stores:
+            book = os.path.join(root, store[:-len(feature_store.STORE_EXT)])
+            if feature_store.countPairs(feature_store.storePath(book)):
+                books.append(book)
+        dirs[:] = [d for d in dirs if not d in stores]
         for file in files:
             parts = file.split('.')
-            if len(parts) > 1 and parts[1] == "weights":
-                books.append(os.path.join(root, parts[0]))
-        
-    train_data = []
-    train_target = []
+            if len(parts) > 1 and parts[1] == "weights" and not parts[0] + feature_store.STORE_EXT in stores:
+                book = os.path.join(root, parts[0])
+                if feature_store.convertWeights(book):
+                    books.append(book)
     
     if len(books) == 0:
         raise Exception("No training data found!")
+    return sorted(books)
+
+
+def getBookData(name):
+    """
+    Returns the features and labels of the pairs of golden characters in a book.
+    """
+    features, labels = feature_store.loadBook(feature_store.storePath(name), name + '.csv')
+    known = labels >= 0
+    return features[known], labels[known]
+
+
+def getTrainData(data_path):
+    """
+    Loads the pair features and labels of all books in data_path from their
+    feature stores.
+    """
+    logging.info('Getting training data from {}...'.format(data_path))
     
-    for name in books:
+    train_data = []
+    train_target = []
+    
+    for name in findBooks(data_path):
         logging.info(name)
-        characters = {}
-        with open(name + '.csv') as f:
-            for line in f.read().splitlines()[1:]:
-                parts = line.split(',')
-                characters[parts[1]] = int(parts[0])
-        
-        with open(name + '.weights') as f:
-            for line in f.read().splitlines():
-                parts = line.split(',')
-                char_A, char_B = parts[0], parts[1]
-                weights = [int(n) for n in parts[2:]]
-                
-                if not char_A in characters or not char_B in characters:
-                    continue
-                
-                if characters[char_A] == characters[char_B]:
-                    train_target.append(1)
-                else:
-                    train_target.append(0)
-                train_data.append(weights)
-    
-    return train_data, train_target
+        features, labels = getBookData(name)
+        train_data.append(features)
+        train_target.append(labels)
+    
+    return np.concatenate(train_data), np.concatenate(train_target)
+
+
+# memory mapped features of all books, opened once by each worker process of crossValidate
+cv_books = None
+
+def initFoldWorker(names):
+    global cv_books
+    cv_books = {}
+    for name in names:
+        cv_books[name] = feature_store.loadBook(feature_store.storePath(name), name + '.csv')
+
+
+def trainFold(task):
+    """
+    Trains a model on all books except the held out one and evaluates it
+    on the held out book.
+    """
+    from sklearn.neural_network import MLPClassifier
+    
+    (held_out, random_state) = task
+    train_data, train_target = [], []
+    for name, (features, labels) in cv_books.items():
+        if not name == held_out:
+            known = labels >= 0
+            train_data.append(features[known])
+            train_target.append(labels[known])
+    features, labels = cv_books[held_out]
+    known = labels >= 0
+    test_data, test_target = features[known], np.asarray(labels[known])
+    
+    model = MLPClassifier(random_state=random_state)
+    model.fit(np.concatenate(train_data), np.concatenate(train_target))
+    proba = model.predict_proba(test_data)[:, 1]
+    
+    metrics = getMetrics(test_target, proba)
+    return held_out, metrics, test_target, proba
+
+
+def getMetrics(target, proba):
+    import sklearn.metrics
+    
+    prediction = proba > 0.5
+    metrics = {
+        'pairs'     : len(target),
+        'accuracy'  : sklearn.metrics.accuracy_score(target, prediction),
+        'precision' : sklearn.metrics.precision_score(target, prediction, zero_division=0),
+        'recall'    : sklearn.metrics.recall_score(target, prediction, zero_division=0),
+        'f1'        : sklearn.metrics.f1_score(target, prediction, zero_division=0)
+    }
+    # AUC is not defined for a book with pairs of one class only
+    if len(set(target.tolist())) == 2:
+        metrics['auc'] = sklearn.metrics.roc_auc_score(target, proba)
+    else:
+        metrics['auc'] = None
+    return metrics
+
+
+def crossValidate(data_path, jobs=None, random_state=13):
+    """
+    Leave-one-book-out cross-validation of the model. The worker processes
+    get only the paths of the books and memory map their feature stores,
+    then train the folds in parallel.
+    
+    Returns:
+        ({book: metrics}, metrics of all held out predictions together)
+    """
+    logging.info('Getting training data from {}...'.format(data_path))
+    books = findBooks(data_path)
+    # labels are computed here once, so that the workers only read them
+    for name in books:
+        feature_store.getLabels(feature_store.storePath(name), name + '.csv')
+    
+    jobs = jobs or os.cpu_count()
+    logging.info("Training {} folds with {} workers...".format(len(books), jobs))
+    fold_metrics = {}
+    all_target, all_proba = [], []
+    tasks = [(name, random_state) for name in books]
+    with multiprocessing.get_context('spawn').Pool(min(jobs, len(tasks)), initializer=initFoldWorker, initargs=(books,)) as pool:
+        for k, (name, metrics, target, proba) in enumerate(pool.imap_unordered(trainFold, tasks)):
+            logging.info("[{}/{}] {} done".format(k+1, len(tasks), name))
+            fold_metrics[name] = metrics
+            all_target.append(target)
+            all_proba.append(proba)
+    
+    return fold_metrics, getMetrics(np.concatenate(all_target), np.concatenate(all_proba))
+
+
+def printCrossValidation(fold_metrics, pooled_metrics):
+    keys = ['pairs', 'accuracy', 'precision', 'recall', 'f1', 'auc']
+    
+    def formatMetrics(metrics):
+        return '  '.join(['{:>9}'.format(metrics[key] if key == 'pairs' else ('-' if metrics[key] == None else '{:.4f}'.format(metrics[key]))) for key in keys])
+    
+    print('{:<40}  {}'.format('book', '  '.join(['{:>9}'.format(key) for key in keys])))
+    for name in sorted(fold_metrics):
+        print('{:<40}  {}'.format(os.path.basename(name), formatMetrics(fold_metrics[name])))
+    
+    mean_metrics = {'pairs': sum([m['pairs'] for m in fold_metrics.values()])}
+    for key in keys[1:]:
+        values = [m[key] for m in fold_metrics.values() if not m[key] == None]
+        mean_metrics[key] = sum(values) / len(values) if values else None
+    print('{:<40}  {}'.format('mean over books', formatMetrics(mean_metrics)))
+    print('{:<40}  {}'.format('all pairs', formatMetrics(pooled_metrics)))
+
+
+def predictRows(model, features, rows, batch_size=4096):
+    """
+    Probabilities of the given rows of a memory mapped feature matrix,
+    read in batches.
+    """
+    proba = np.empty(len(rows))
+    for start in range(0, len(rows), batch_size):
+        proba[start:start+batch_size] = model.predict_proba(features[rows[start:start+batch_size]])[:, 1]
+    return proba
+
+
+def sampleBook(features, labels, rng, negative_ratio, model=None, easy_threshold=0.1):
+    """
+    Selects the pairs of golden characters of a book for one epoch of
+    streaming training: all positives and hard negatives, and each easy
+    negative with probability negative_ratio and weight 1/negative_ratio,
+    so that the weighted loss is an unbiased estimate of the full one.
+    
+    A negative is easy if the model trained so far gives it a probability
+    below easy_threshold; without a model all negatives are easy.
+    
+    Returns:
+        (rows, weights, target)
+    """
+    known = np.flatnonzero(np.asarray(labels) >= 0)
+    target = np.asarray(labels[known]).astype(np.int64)
+    easy = target == 0
+    if not model == None and easy.any():
+        easy[easy] = predictRows(model, features, known[easy]) < easy_threshold
+    
+    keep = ~easy | (rng.random(len(known)) < negative_ratio)
+    weights = np.where(easy, 1 / negative_ratio, 1.0)
+    return known[keep], weights[keep], target[keep]
+
+
+def trainStreaming(books, negative_ratio=0.1, batch_size=200, epochs=20, random_state=13):
+    """
+    Trains the model with partial_fit on minibatches, reading one memory
+    mapped book at a time in a random order each epoch. Only the row
+    indices of the current book and one minibatch are in memory, however
+    many books there are.
+    """
+    from sklearn.neural_network import MLPClassifier
+    
+    rng = np.random.default_rng(random_state)
+    model = MLPClassifier(random_state=random_state, batch_size=batch_size)
+    trained = False
+    for epoch in range(epochs):
+        pairs = 0
+        for name in rng.permutation(books):
+            features, labels = feature_store.loadBook(feature_store.storePath(name), name + '.csv')
+            rows, weights, target = sampleBook(features, labels, rng, negative_ratio, model if trained else None)
+            order = rng.permutation(len(rows))
+            for start in range(0, len(rows), batch_size):
+                batch = order[start:start+batch_size]
+                model.partial_fit(features[rows[batch]], target[batch], sample_weight=weights[batch], classes=[0, 1])
+                trained = True
+            pairs += len(rows)
+        logging.info("Epoch {}/{}: {} pairs, loss {:.4f}".format(epoch+1, epochs, pairs, model.loss_ if trained else 0))
+    return model
+
+
+def benchmarkStreaming(data_path, negative_ratios=[1.0, 0.3, 0.1], batch_size=200, epochs=20, random_state=13):
+    """
+    Compares the full batch training with streaming training for several
+    negative ratios. Every fifth book is held out for testing.
+    
+    Returns:
+        [(method, training time in seconds, metrics on the held out books)]
+    """
+    books = findBooks(data_path)
+    test_books = books[::5]
+    train_books = [name for name in books if not name in test_books]
+    if not train_books:
+        raise Exception("At least two books are needed for the benchmark!")
+    test_data = [getBookData(name) for name in test_books]
+    
+    def evaluate(model):
+        target = np.concatenate([np.asarray(labels) for features, labels in test_data])
+        proba = np.concatenate([predictRows(model, features, np.arange(len(features))) for features, labels in test_data])
+        return getMetrics(target, proba)
+    
+    from sklearn.neural_network import MLPClassifier
+    results = []
+    start = time.time()
+    train_data, train_target = [], []
+    for name in train_books:
+        features, labels = getBookData(name)
+        train_data.append(features)
+        train_target.append(labels)
+    model = MLPClassifier(random_state=random_state)
+    model.fit(np.concatenate(train_data), np.concatenate(train_target))
+    results.append(('full batch', time.time() - start, evaluate(model)))
+    del train_data, train_target
+    
+    for negative_ratio in negative_ratios:
+        start = time.time()
+        model = trainStreaming(train_books, negative_ratio, batch_size, epochs, random_state)
+        results.append(('stream, negatives {:g}'.format(negative_ratio), time.time() - start, evaluate(model)))
+    return results
+
 
+def printBenchmark(results):
+    keys = ['accuracy', 'precision', 'recall', 'f1', 'auc']
+    print('{:<24}  {:>9}  {}'.format('method', 'time [s]', '  '.join(['{:>9}'.format(key) for key in keys])))
+    for method, elapsed, metrics in results:
+        values = ['{:>9}'.format('-' if metrics[key] == None else '{:.4f}'.format(metrics[key])) for key in keys]
+        print('{:<24}  {:>9.1f}  {}'.format(method, elapsed, '  '.join(values)))
@@ -0,0 +1,56 @@
+class UnionFind:
+    """
+    Disjoint sets of graph nodes with path halving and union by size.
+    Nodes are added lazily on the first find.
+    """
+    def __init__(self, nodes=[]):
+        self.parent = {}
+        self.size = {}
+        for node in nodes:
+            self.add(node)
+    
+    def add(self, node):
+        if not node in self.parent:
+            self.parent[node] = node
+            self.size[node] = 1
+    
+    def find(self, node):
+        self.add(node)
+        parent = self.parent
+        while not parent[node] == node:
+            parent[node] = parent[parent[node]]
+            node = parent[node]
+        return node
+    
+    def union(self, node_A, node_B):
+        """
+        Merges the sets of both nodes.
+        
+        Returns:
+            (root, merged_root): the root of the merged set and the root that was
+            merged into it, or (root, None) if both nodes were in the same set.
+        """
+        root_A, root_B = self.find(node_A), self.find(node_B)
+        if root_A == root_B:
+            return root_A, None
+        if self.size[root_A] < self.size[root_B]:
+            root_A, root_B = root_B, root_A
+        self.parent[root_B] = root_A
+        self.size[root_A] += self.size[root_B]
+        return root_A, root_B
+    
+    def copy(self):
+        other = UnionFind()
+        other.parent = dict(self.parent)
+        other.size = dict(self.size)
+        return other
+    
+    def sets(self):
+        groups = {}
+        for node in self.parent:
+            root = self.find(node)
+            if root in groups:
+                groups[root].append(node)
+            else:
+                groups[root] = [node]
+        return list(groups.values())
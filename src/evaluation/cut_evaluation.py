@@ -0,0 +1,138 @@
+import time
+import networkx as nx
+
+import character_extraction.character_extraction as character_extraction
+import character_extraction.name_unification_graph as name_unification_graph
+
+
+class CutEvaluator:
+    """
+    Compares the characters found when conflicting name pairs are cut along
+    shortest paths (the original algorithm) and with the maximum spanning tree.
+    Both methods start from the same graph and edge predictions.
+    
+    Also checks that CharacterExtractor.extractCharacterSettings gives the
+    same characters as extractCharacters for a grid of settings.
+    """
+    def __init__(self, docs, model_path, edge_maxprob=0.9, character_remove_limit=3):
+        self.docs = docs
+        self.model_path = model_path
+        self.edge_maxprob = edge_maxprob
+        self.character_remove_limit = character_remove_limit
+    
+    def evaluate(self):
+        extractor = character_extraction.CharacterExtractor(self.docs)
+        G = name_unification_graph.CharacterUnificationGraph(self.docs, extractor.clusters).createGraph()
+        edge_prediction = extractor.predictProba(G, self.model_path)
+        
+        results = {}
+        for method, shortest_paths in [('shortest_paths', True), ('spanning_tree', False)]:
+            final_graph = extractor.initFinalGraph(G, edge_prediction)
+            start = time.perf_counter()
+            final_graph = extractor.removeNodes(final_graph, G, edge_prediction, self.edge_maxprob, self.character_remove_limit, shortest_paths=shortest_paths)
+            elapsed = time.perf_counter() - start
+            components = [frozenset(c) for c in nx.connected_components(final_graph)]
+            results[method] = {
+                'time'       : elapsed,
+                'components' : len(components),
+                'conflicts'  : self.countConflicts(components, edge_prediction),
+                'partition'  : components
+            }
+        
+        old, new = results['shortest_paths']['partition'], results['spanning_tree']['partition']
+        results['identical_components'] = len(set(old) & set(new))
+        results['rand_index'] = self.getRandIndex(old, new)
+        return results
+    
+    def settingsGrid(self):
+        maxprobs = sorted(set([self.edge_maxprob, 0.8, 1.0]), reverse=True)
+        remove_limits = sorted(set([0, self.character_remove_limit]))
+        return [(edge_maxprob, remove_limit) for edge_maxprob in maxprobs for remove_limit in remove_limits]
+    
+    def compareSettings(self, settings=None):
+        """
+        Extracts characters for all settings at once and one by one, with
+        both methods of cutting.
+        
+        Returns:
+            {method: {'sweep_time', 'loop_time', 'settings', 'different': [settings]}}
+        """
+        settings = settings or self.settingsGrid()
+        extractor = character_extraction.CharacterExtractor(self.docs)
+        
+        results = {}
+        for method, shortest_paths in [('shortest_paths', True), ('spanning_tree', False)]:
+            start = time.perf_counter()
+            all_characters = extractor.extractCharacterSettings(self.model_path, settings, shortest_paths)
+            sweep_time = time.perf_counter() - start
+            
+            different = []
+            start = time.perf_counter()
+            for edge_maxprob, remove_limit in settings:
+                characters = extractor.extractCharacters(self.model_path, edge_maxprob, remove_limit, shortest_paths=shortest_paths)
+                if not self.sameCharacters(characters, all_characters[(edge_maxprob, remove_limit)]):
+                    different.append((edge_maxprob, remove_limit))
+            loop_time = time.perf_counter() - start
+            
+            results[method] = {
+                'sweep_time' : sweep_time,
+                'loop_time'  : loop_time,
+                'settings'   : len(settings),
+                'different'  : different
+            }
+        return results
+    
+    def sameCharacters(self, characters_A, characters_B):
+        normalize = lambda characters: sorted((sorted(variants), gender) for variants, gender in characters.values())
+        return normalize(characters_A) == normalize(characters_B)
+    
+    def countConflicts(self, components, edge_prediction):
+        """
+        Number of pairs with probability < 0.1 left in one component.
+        """
+        component_of = {}
+        for i, c in enumerate(components):
+            for node in c:
+                component_of[node] = i
+        conflicts = 0
+        for (name_A, name_B), prob in edge_prediction.items():
+            if prob < 0.1 and name_A in component_of and component_of[name_A] == component_of.get(name_B):
+                conflicts += 1
+        return conflicts
+    
+    def getRandIndex(self, partition_A, partition_B):
+        """
+        Rand index over the names kept by both methods.
+        """
+        label_A, label_B = {}, {}
+        for i, c in enumerate(partition_A):
+            for node in c:
+                label_A[node] = i
+        for i, c in enumerate(partition_B):
+            for node in c:
+                label_B[node] = i
+        nodes = [node for node in label_A if node in label_B]
+        
+        agree, total = 0, 0
+        for i, node_X in enumerate(nodes):
+            for node_Y in nodes[i+1:]:
+                same_A = label_A[node_X] == label_A[node_Y]
+                same_B = label_B[node_X] == label_B[node_Y]
+                agree += same_A == same_B
+                total += 1
+        if not total:
+            return 1.0
+        return agree / total
+    
+    def printResults(self, results):
+        for method in ['shortest_paths', 'spanning_tree']:
+            r = results[method]
+            print("{}: {} characters, {} conflicting pairs left, {:.3f} s".format(method, r['components'], r['conflicts'], r['time']))
+        print("identical characters: {}, rand index: {:.4f}".format(results['identical_components'], results['rand_index']))
+    
+    def printSettingsResults(self, results):
+        for method in ['shortest_paths', 'spanning_tree']:
+            r = results[method]
+            print("{}: {} settings in {:.3f} s at once, {:.3f} s one by one, {} different".format(method, r['settings'], r['sweep_time'], r['loop_time'], len(r['different'])))
+            for edge_maxprob, remove_limit in r['different']:
+                print("\tdifferent characters for maxprob {}, removelimit {}".format(edge_maxprob, remove_limit))
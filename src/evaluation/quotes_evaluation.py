@@ -146,7 +146,9 @@ class QuotesEvaluator:
                     f.write("true_speaker:" + str(true_speaker) + '\n')
                     f.write("speaker_type:" + str(speaker_type) + '\n')
                     f.write("result:" + str(result) + '\n')
-                    if doc._.quotes:
+                    # the speakers lists are made only for the docs reaching
+                    # majoritySpeaker, unless MentionSpeaker.fillSpeakersLists is called
+                    if doc._.quotes and not doc._.speakers_list == None:
                         f.write("SPEAKERS:" + '\n')
                         for speaker_id, count in doc._.speakers_list:
                             f.write('\t' + self.char_dict[speaker_id] + str(count) + '\n')
@@ -175,13 +177,23 @@ class QuotesEvaluator:
 
 
 class QuotesEvaluatorQuoteLi3(QuotesEvaluator):
+    def getGoldData(self):
+        """
+        The parsed golden file, parsed and checked against the texts of the
+        docs once per evaluator.
+        """
+        if not hasattr(self, 'gold_data'):
+            gold_data = self.parse(self.golden)
+            self.checkTextsSame(gold_data, self.docs)
+            self.gold_data = gold_data
+        return self.gold_data
+    
     def addGoldSpeakers(self):
-        gold_data = self.parse(self.golden)
+        gold_data = self.getGoldData()
         if not Doc.has_extension('gold_speaker'):
             Doc.set_extension('gold_speaker', default=None)
         if not Doc.has_extension('gold_match_id'):
             Doc.set_extension('gold_match_id', default=None)
-        self.checkTextsSame(gold_data, self.docs)
         for (gold_text, gold_speaker), doc in zip(gold_data, self.docs):
             doc._.gold_speaker = gold_speaker
         
@@ -204,13 +216,11 @@ class QuotesEvaluatorQuoteLi3(QuotesEvaluator):
     
     
     def evaluate(self):
-        gold_data = self.parse(self.golden)
+        gold_data = self.getGoldData()
         
         gold_texts = [text for (text, _) in gold_data]
         gold_speakers = [speaker for (_, speaker) in gold_data]
         
-        self.checkTextsSame(gold_data, self.docs)
-        
         predicted = [doc._.speaker_id for doc in self.docs]
         B = self.buildGraph(predicted, gold_speakers)
         matching = self.getMatching(B)
@@ -219,18 +229,31 @@ class QuotesEvaluatorQuoteLi3(QuotesEvaluator):
         return accuracy
             
     def evaluatePR(self):
-        gold_data = self.parse(self.golden)
+        gold_data = self.getGoldData()
         
         gold_texts = [text for (text, _) in gold_data]
         gold_speakers = [speaker for (_, speaker) in gold_data]
         
-        self.checkTextsSame(gold_data, self.docs)
-        
         predicted = [doc._.speaker_id for doc in self.docs]
         B = self.buildGraph(predicted, gold_speakers)
         matching = self.getMatching(B)
         return self.getPR(B, matching, gold_speakers, predicted)
     
+    def evaluateAll(self):
+        """
+        Accuracy, precision and recall from one matching. Precision and
+        recall are 0 when no quote with a golden speaker is attributed.
+        """
+        gold_speakers = [speaker for (_, speaker) in self.getGoldData()]
+        predicted = [doc._.speaker_id for doc in self.docs]
+        B = self.buildGraph(predicted, gold_speakers)
+        matching = self.getMatching(B)
+        accuracy = self.getAccuracy(B, matching, gold_speakers)
+        if not any((not pred == None) and gold for gold, pred in zip(gold_speakers, predicted)):
+            return accuracy, 0.0, 0.0
+        precision, recall = self.getPR(B, matching, gold_speakers, predicted)
+        return accuracy, precision, recall
+    
 
     def parse(self, golden_file):
         tree = ET.parse(golden_file)
@@ -0,0 +1,193 @@
+import json
+import logging
+import time
+import multiprocessing
+
+import spacy
+from spacy.tokens import Doc, Span, Token, DocBin
+
+import quote_attribution.quote_attribution as quote_attribution
+import quote_attribution.mention_speaker as mention_speaker
+import quote_attribution.sieve_executor as sieve_executor
+import evaluation.quotes_evaluation as quotes_evaluation
+
+
+class SieveAblation:
+    """
+    Evaluates the quote attribution with other subsets and orders of sieves.
+
+    A configuration is a list of mention sieves and a list of speaker sieves,
+    run as steps one sieve at a time. The state of the docs with quotes is
+    saved after every step, keyed by the steps run so far, so a configuration
+    starts from the saved state of its longest prefix already evaluated and
+    runs only the remaining sieves. The speakers lists do not depend on the
+    sieves, each is made once, when a sieve first needs it.
+
+    Each configuration is scored with QuotesEvaluatorQuoteLi3.
+    """
+    FIELDS = ['mention', 'mention_sieve', 'speaker_id', 'speaker_sieve']
+
+    def __init__(self, docs, characters, gold_file):
+        self.docs = docs
+        attributor = quote_attribution.QuoteAttributor(docs, characters)
+        self.executor = sieve_executor.SieveExecutor(docs)
+
+        self.mention_sieves = dict((sieve.sieve_name, sieve) for sieve in attributor.qo_me.getSieves())
+        me_sp = attributor.me_sp
+        speaker_sieves = me_sp.getSieves() + [mention_speaker.ClosestNameBefore(docs, me_sp.name_dict, me_sp.gender_dict, me_sp.gendered_words)]
+        self.speaker_sieves = dict((sieve.sieve_name, sieve) for sieve in speaker_sieves)
+
+        self.evaluator = quotes_evaluation.QuotesEvaluatorQuoteLi3(docs, gold_file, characters)
+
+        for i in self.executor.quote_docs:
+            for field in SieveAblation.FIELDS + ['speakers_list']:
+                setattr(docs[i]._, field, None)
+        me_sp.makeSpeakersLists()
+        self.snapshots = {(): self.snapshot()}
+
+    def snapshot(self):
+        return [tuple(getattr(self.docs[i]._, field) for field in SieveAblation.FIELDS) for i in self.executor.quote_docs]
+
+    def restore(self, snapshot):
+        for i, values in zip(self.executor.quote_docs, snapshot):
+            for field, value in zip(SieveAblation.FIELDS, values):
+                setattr(self.docs[i]._, field, value)
+
+    def getSteps(self, config):
+        """
+        Returns:
+            the steps of a configuration, (phase, sieve name) in the order they run
+        """
+        (mention_names, speaker_names) = config
+        for name in mention_names:
+            if not name in self.mention_sieves:
+                raise ValueError("Unknown mention sieve '{}', the mention sieves are: {}".format(name, ', '.join(self.mention_sieves)))
+        for name in speaker_names:
+            if not name in self.speaker_sieves:
+                raise ValueError("Unknown speaker sieve '{}', the speaker sieves are: {}".format(name, ', '.join(self.speaker_sieves)))
+        return tuple([('mention', name) for name in mention_names] + [('speaker', name) for name in speaker_names])
+
+    def runStep(self, step):
+        (phase, name) = step
+        if phase == 'mention':
+            self.executor.runMentionSieves([self.mention_sieves[name]])
+        else:
+            self.executor.runSpeakerSieves([self.speaker_sieves[name]])
+
+    def evaluate(self, config):
+        """
+        Returns:
+            {'config', 'accuracy', 'precision', 'recall', 'attributed', 'steps_run'}
+        """
+        steps = self.getSteps(config)
+        k = len(steps)
+        while not steps[:k] in self.snapshots:
+            k -= 1
+        self.restore(self.snapshots[steps[:k]])
+        for j in range(k, len(steps)):
+            self.runStep(steps[j])
+            self.snapshots[steps[:j+1]] = self.snapshot()
+
+        attributed = len([i for i in self.executor.quote_docs if not self.docs[i]._.speaker_id == None])
+        accuracy, precision, recall = self.evaluator.evaluateAll()
+        return {'config': config, 'accuracy': accuracy, 'precision': precision, 'recall': recall,
+                'attributed': attributed, 'steps_run': len(steps) - k}
+
+
+def defaultConfigurations():
+    """
+    The sieves of QuoteAttributor, each sieve left out, each pair of
+    neighbouring sieves swapped and the unused closestNameBefore sieve
+    inserted at every position.
+    """
+    mention_names = ["trigramMatch", "previousParDetermined", "commonSpeechVerb", "singleMention",
+                     "previousVocativeDetection", "finalMention", "conversationalPattern", "looseConversationalPattern"]
+    speaker_names = ["exactNameMatch", "coreference", "conversationalPattern", "majoritySpeaker"]
+
+    configs = [(mention_names, speaker_names)]
+    for k in range(len(mention_names)):
+        configs.append((mention_names[:k] + mention_names[k+1:], speaker_names))
+    for k in range(len(speaker_names)):
+        configs.append((mention_names, speaker_names[:k] + speaker_names[k+1:]))
+    for k in range(len(mention_names) - 1):
+        configs.append((mention_names[:k] + [mention_names[k+1], mention_names[k]] + mention_names[k+2:], speaker_names))
+    for k in range(len(speaker_names) - 1):
+        configs.append((mention_names, speaker_names[:k] + [speaker_names[k+1], speaker_names[k]] + speaker_names[k+2:]))
+    for k in range(len(speaker_names) + 1):
+        configs.append((mention_names, speaker_names[:k] + ["closestNameBefore"] + speaker_names[k:]))
+    return [(tuple(mention), tuple(speaker)) for mention, speaker in configs]
+
+
+def loadConfigurations(config_file):
+    """
+    Reads configurations from a json list of {"mention": [sieve names], "speaker": [sieve names]}.
+    """
+    with open(config_file) as f:
+        data = json.load(f)
+    return [(tuple(config['mention']), tuple(config['speaker'])) for config in data]
+
+
+# the ablation of a worker process of runAblation, created once per worker
+worker_ablation = None
+
+def initAblationWorker(doc_bytes, characters, gold_file):
+    global worker_ablation
+    import annotation.annotation as annotation
+    import character_extraction.character_extraction as character_extraction
+
+    # the extensions are set unless the main module of the spawned process already set them
+    if not Doc.has_extension("cluster_ids"):
+        annotation.CorefModel.setExtensions()
+    if not Token.has_extension("is_honorific"):
+        annotation.EntityModifier.setExtensions()
+    if not Doc.has_extension("quotes"):
+        annotation.QuoteParser.setExtensions()
+    if not Span.has_extension("nameless_name"):
+        annotation.Annotator.setExtensions()
+    character_extraction.CharacterExtractor.setExtensions()
+
+    docs = list(DocBin().from_bytes(doc_bytes).get_docs(spacy.blank("en").vocab))
+    worker_ablation = SieveAblation(docs, characters, gold_file)
+
+
+def ablationWorker(configs):
+    return [worker_ablation.evaluate(config) for config in configs]
+
+
+def runAblation(docs, characters, gold_file, configs, jobs=1):
+    """
+    Evaluates all configurations. Configurations sharing a prefix of sieves
+    are sorted next to each other and evaluated by the same worker, so they
+    reuse its saved states.
+
+    Returns:
+        results of SieveAblation.evaluate, in the order of configs
+    """
+    start = time.time()
+    order = sorted(range(len(configs)), key=lambda k: (configs[k][0], configs[k][1]))
+
+    if jobs <= 1:
+        ablation = SieveAblation(docs, characters, gold_file)
+        results = dict((k, ablation.evaluate(configs[k])) for k in order)
+    else:
+        # contiguous chunks of the sorted configurations
+        chunks = [order[len(order) * w // jobs:len(order) * (w+1) // jobs] for w in range(jobs)]
+        chunks = [chunk for chunk in chunks if chunk]
+        doc_bytes = DocBin(store_user_data=True, docs=docs).to_bytes()
+        with multiprocessing.get_context('spawn').Pool(len(chunks), initializer=initAblationWorker, initargs=(doc_bytes, characters, gold_file)) as pool:
+            chunk_results = pool.map(ablationWorker, [[configs[k] for k in chunk] for chunk in chunks])
+        results = {}
+        for chunk, chunk_result in zip(chunks, chunk_results):
+            results.update(zip(chunk, chunk_result))
+
+    logging.info("{} configurations evaluated in {:.1f} s.".format(len(configs), time.time() - start))
+    return [results[k] for k in range(len(configs))]
+
+
+def printResults(results):
+    print("{:>8} {:>9} {:>6} {:>10} {:>5}  {}".format("accuracy", "precision", "recall", "attributed", "steps", "sieves"))
+    for result in sorted(results, key=lambda result: result['accuracy'], reverse=True):
+        (mention_names, speaker_names) = result['config']
+        print("{:8.2f} {:9.2f} {:6.2f} {:10d} {:5d}  mention: {}".format(
+            100*result['accuracy'], 100*result['precision'], 100*result['recall'], result['attributed'], result['steps_run'], ', '.join(mention_names)))
+        print("{:>44}  speaker: {}".format("", ', '.join(speaker_names)))
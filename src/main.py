@@ -4,22 +4,45 @@ import text_preproc.text_preproc as text_preproc
 import annotation.annotation as annotation
 import character_extraction.character_extraction as character_extraction
 import character_extraction.name_unification_model as model
+import character_extraction.character_registry as character_registry
+import character_extraction.feature_store as feature_store
 import quote_attribution.quote_attribution as quote_attribution
 import network_creation.network_creation as network_creation
 import output_format.out_formatter as out_formatter
+import serial_processing.serial_processing as serial_processing
 
 import evaluation.quotes_evaluation as quotes_evaluation
 import evaluation.character_evaluation as character_evaluation
+import evaluation.cut_evaluation as cut_evaluation
+import evaluation.sieve_ablation as sieve_ablation
 
 import logging
 import argparse
 import os
 import pickle
+import time
+import multiprocessing
 
 import spacy
 from spacy.tokens import DocBin
 
 
+def cooccurrenceWindow(value):
+    """
+    argparse type of --window: 'paragraph', 'sentence' or a positive number
+    of tokens
+    """
+    if value in ['paragraph', 'sentence']:
+        return value
+    try:
+        tokens = int(value)
+    except ValueError:
+        tokens = 0
+    if tokens <= 0:
+        raise argparse.ArgumentTypeError("expected 'paragraph', 'sentence' or a positive number of tokens, got '{}'".format(value))
+    return tokens
+
+
 def init():
     logging.basicConfig(format='%(message)s', level=logging.INFO)
     
@@ -35,27 +58,170 @@ def init():
     run_parser.add_argument('-n', '--nosave', action='store_true', help='Does not save the annotated data')
     run_parser.add_argument('--goldcharacters', help='The list of golden characters')
     run_parser.add_argument('--goldxml', help='The file annotated with golden speakers')
+    run_parser.add_argument('--registry', help='Registry of characters of a series, updated with the characters of the book')
+    run_parser.add_argument('--spanningtree', action='store_true', help='Separates conflicting names with the faster spanning tree cut instead of shortest paths')
+    run_parser.add_argument('-j', '--jobs', type=int, default=1, help='Number of worker processes attributing the speakers, each to a part of the book')
+    run_parser.add_argument('--window', type=cooccurrenceWindow, default='paragraph', help="Characters co-occur in the same 'paragraph', 'sentence' or within the given number of tokens")
+    run_parser.add_argument('--weighted', action='store_true', help='Weights co-occurrences within a number of tokens by their distance')
+    run_parser.add_argument('--dynamic', type=int, help='Also saves the networks of windows of this many paragraphs as timestamped edge lists')
+    run_parser.add_argument('--step', type=int, help='Number of paragraphs between the windows of --dynamic, the window size by default')
+    run_parser.add_argument('--speakers-out', help="Writes a json line per paragraph with its quotes and speaker as soon as they are attributed, to this file or '-' for the standard output")
+    
+    serial_parser = subparsers.add_parser('serial', help='Add a new chapter to a serialized book processed so far',
+                                          description='Adds a new chapter to a serialized book processed so far. Only the new paragraphs are annotated, '
+                                          'but the characters are still extracted from all chapters, so each chapter takes time linear in the length '
+                                          'of the book: the name pair features and the separation of conflicting names depend on the whole text.')
+    serial_parser.add_argument('--chapter', required=True, help='Path to the text of the new chapter')
+    serial_parser.add_argument('--book', default='data/example/serial.docbin', help='Path to the docbin of the chapters processed so far, created if it does not exist')
+    serial_parser.add_argument('--out', default='out', help='Path to the output directory')
+    serial_parser.add_argument('--model', default='models/all_data.model', help='Path to the trained model')
+    serial_parser.add_argument('--maxprob', type=float, default=0.9, help='The max probability of edges removed in Character Detection')
+    serial_parser.add_argument('--removelimit', type=int, default=3, help='The minimum number of occurences of a character to be counted')
     
     collect_parser = subparsers.add_parser('collect', help='Collect data to train a model')
     collect_parser.add_argument('--path', default='data/data_vala', help='Path to the book directory')
-    collect_parser.add_argument('-n', '--nosave', action='store_true', help='Does not save the annotated data, saves only the weights')
+    collect_parser.add_argument('-n', '--nosave', action='store_true', help='Does not save the annotated data, saves only the pair features')
+    collect_parser.add_argument('-j', '--jobs', type=int, default=1, help='Number of books annotated in parallel worker processes')
     
     train_parser = subparsers.add_parser('train', help='Train a model to recognize character name equality')
-    train_parser.add_argument('--path', default='data/data_vala', help='Path to the directory with character pair weights')
+    train_parser.add_argument('--path', default='data/data_vala', help='Path to the directory with character pair features')
     train_parser.add_argument('--out', default='models/all_data.model', help='Path to save the model')
+    train_parser.add_argument('--cv', action='store_true', help='Only evaluate the model with leave-one-book-out cross-validation')
+    train_parser.add_argument('-j', '--jobs', type=int, help='Number of folds trained in parallel, all cores by default')
+    train_parser.add_argument('--stream', action='store_true', help='Trains on minibatches streamed book by book, with subsampled easy negatives')
+    train_parser.add_argument('--negratio', type=float, default=0.1, help='The fraction of easy negative pairs kept in each epoch of streamed training')
+    train_parser.add_argument('--epochs', type=int, default=20, help='The number of epochs of streamed training')
+    train_parser.add_argument('--batchsize', type=int, default=200, help='The minibatch size of streamed training')
+    train_parser.add_argument('--benchmark', action='store_true', help='Only compares the time and accuracy of full batch and streamed training')
+    
+    export_parser = subparsers.add_parser('export', help='Export the weights of a trained model for inference without sklearn')
+    export_parser.add_argument('--model', default='models/all_data.model', help='Path to the trained model')
+    export_parser.add_argument('--out', help='Path to save the weights, defaults to the model path with .npz extension')
     
     evaluate_parser = subparsers.add_parser('evaluate', help='Evaluate the accuracy')
-    evaluate_parser.add_argument('type', choices=['characters', 'quotes'], help='Choose the type of evaluation')
+    evaluate_parser.add_argument('type', choices=['characters', 'quotes', 'cuts', 'sieves'], help='Choose the type of evaluation')
     evaluate_parser.add_argument('--file', required=True, help='Docbin file to be evaluated')
     evaluate_parser.add_argument('--goldxml', help='The golden data for quotes evaluation')
     evaluate_parser.add_argument('--goldcharacters', help='The golden characters for character evaluation')
     evaluate_parser.add_argument('--model', default='models/all_data.model', help='Path to the trained model')
     evaluate_parser.add_argument('--maxprob', type=float, default=0.9, help='The max probability of edges removed in Character Detection')
     evaluate_parser.add_argument('--removelimit', type=int, default=3, help='The minimum number of occurences of a character to be counted')
+    evaluate_parser.add_argument('--configs', help='Json list of the sieve configurations evaluated by the type sieves, {"mention": [names], "speaker": [names]}')
+    evaluate_parser.add_argument('-j', '--jobs', type=int, default=1, help='Number of worker processes evaluating the sieve configurations')
     
     return parser, run_parser
 
 
+def saveDocs(docs, doc_file):
+    """
+    Saves the annotated docs to a temporary file first and renames it, so that
+    a failure never leaves a corrupted docbin behind.
+    """
+    doc_bin = DocBin(store_user_data=True, docs=docs)
+    tmp_file = doc_file + '.tmp{}'.format(os.getpid())
+    with open(tmp_file, 'wb') as f:
+        f.write(doc_bin.to_bytes())
+    os.replace(tmp_file, doc_file)
+
+
+def loadDocs(doc_file, vocab):
+    logging.info("Loading docs from file '{}'...".format(doc_file))
+    doc_bin = DocBin().from_disk(doc_file)
+    return list(doc_bin.get_docs(vocab))
+
+
+def findBooks(path):
+    """
+    Returns (directory, file) of all books in path with no collected data yet.
+    """
+    books = []
+    for root, dirs, files in os.walk(path):
+        stores = [d for d in dirs if d.endswith(feature_store.STORE_EXT)]
+        dirs[:] = [d for d in dirs if not d in stores]
+        for file in sorted(files):
+            if not 'txt' == file.split('.')[-1]:
+                continue
+            if file.split('.')[0] + '.weights' in files or file.split('.')[0] + feature_store.STORE_EXT in stores:
+                continue
+            books.append((root, file))
+    return books
+
+
+def collectBook(annotator, root, file, nosave):
+    book = os.path.join(root, file.split('.')[0])
+    paragraphs = text_preproc.getPars(os.path.join(root, file))
+    docs = annotator.annotate(paragraphs)
+    if not nosave:
+        saveDocs(docs, book + '.docbin')
+        logging.info("Annotated docs saved to file {}".format(book + '.docbin'))
+    
+    # the feature store marks the book as collected, so it is saved last
+    character_extractor = character_extraction.CharacterExtractor(docs)
+    character_extractor.saveFeatures(book)
+    logging.info("Features saved to {}".format(feature_store.storePath(book)))
+
+
+# the annotator of a worker process of collect, loaded once per worker
+worker_annotator = None
+
+def initCollectWorker():
+    global worker_annotator
+    logging.basicConfig(format='%(message)s', level=logging.INFO)
+    worker_annotator = annotation.Annotator()
+
+
+def tryCollectBook(annotator, root, file, nosave):
+    """
+    Returns:
+        (book file, elapsed seconds, error or None)
+    """
+    start = time.time()
+    try:
+        collectBook(annotator, root, file, nosave)
+    except Exception as e:
+        return (os.path.join(root, file), time.time() - start, repr(e))
+    return (os.path.join(root, file), time.time() - start, None)
+
+
+def collectWorker(task):
+    (root, file, nosave) = task
+    return tryCollectBook(worker_annotator, root, file, nosave)
+
+
+def collectBooks(path, nosave, jobs=1):
+    """
+    Annotates all books in path and saves the data for training. With more
+    than one job, books are processed in worker processes, each with its own
+    annotator. A failed book is reported and does not stop the others.
+    """
+    books = findBooks(path)
+    logging.info("Collecting data from {} books...".format(len(books)))
+    start = time.time()
+    failed = []
+    
+    def report(k, book_file, elapsed, error):
+        if error:
+            failed.append(book_file)
+            logging.error("[{}/{}] Collecting data from {} failed: {}".format(k+1, len(books), book_file, error))
+        else:
+            logging.info("[{}/{}] Data from {} collected in {:.0f} s".format(k+1, len(books), book_file, elapsed))
+    
+    if jobs <= 1:
+        annotator = annotation.Annotator()
+        for k, (root, file) in enumerate(books):
+            logging.info("[{}/{}] Collecting data from file {}".format(k+1, len(books), os.path.join(root, file)))
+            report(k, *tryCollectBook(annotator, root, file, nosave))
+    else:
+        tasks = [(root, file, nosave) for (root, file) in books]
+        with multiprocessing.get_context('spawn').Pool(jobs, initializer=initCollectWorker) as pool:
+            for k, result in enumerate(pool.imap_unordered(collectWorker, tasks)):
+                report(k, *result)
+    
+    logging.info("Collected {} books in {:.0f} s.".format(len(books) - len(failed), time.time() - start))
+    if failed:
+        logging.error("Failed books:\n\t{}".format('\n\t'.join(failed)))
+
+
 def main():
     parser, def_parser = init()
     args, extras = parser.parse_known_args()
@@ -76,8 +242,7 @@ def main():
             docs = annotation.Annotator().annotate(paragraphs)
         
         if not args.nosave:
-            doc_bin = DocBin(store_user_data=True, docs=docs)
-            doc_bin.to_disk(book.split('.')[0] + '.docbin')
+            saveDocs(docs, book.split('.')[0] + '.docbin')
             logging.info("Annotated docs saved to {}".format(book.split('.')[0] + '.docbin'))
         
         # Phase 1: extract characters
@@ -95,53 +260,79 @@ character id, character name, characted gender""")
             character_extractor = character_extraction.FalseCharacterExtractor(docs, characters)
         else:
             character_extractor = character_extraction.CharacterExtractor(docs)
-        characters = character_extractor.extractCharacters(args.model, args.maxprob, args.removelimit)
+        if args.registry and not args.goldcharacters:
+            registry = character_registry.CharacterRegistry.load(args.registry)
+            characters = character_extractor.extractCharacters(args.model, args.maxprob, args.removelimit, registry, not args.spanningtree)
+            registry.save(args.registry)
+        else:
+            characters = character_extractor.extractCharacters(args.model, args.maxprob, args.removelimit, shortest_paths=not args.spanningtree)
         
         # Phase 2: assign speakers to quotes
         if args.goldxml:
             quote_attributor = quote_attribution.FalseQuoteAttributor(docs, characters, args.goldxml)
+        elif args.jobs > 1:
+            quote_attributor = quote_attribution.ShardedQuoteAttributor(docs, characters, args.jobs)
         else:
             quote_attributor = quote_attribution.QuoteAttributor(docs, characters)
-        assigned_speakers_docs = quote_attributor.extractSpeakers()
+        if args.speakers_out and not args.goldxml:
+            out_formatter.outputSpeakerRecords(docs, quote_attributor.streamSpeakers(), characters, args.speakers_out)
+            assigned_speakers_docs = docs
+        else:
+            assigned_speakers_docs = quote_attributor.extractSpeakers()
+            if args.speakers_out:
+                out_formatter.outputSpeakerRecords(docs, range(len(docs)), characters, args.speakers_out)
         
         # Phase 3: create character network
-        network_creator = network_creation.NetworkCreator(assigned_speakers_docs, characters)
-        cooccurrenceG, conversationG, goldConversationG = network_creator.createNetworks(golden_speakers=args.goldxml)
+        network_creator = network_creation.NetworkCreator(assigned_speakers_docs, characters, quote_attributor.novel)
+        cooccurrenceG, conversationG, goldConversationG = network_creator.createNetworks(golden_speakers=args.goldxml, window=args.window, weighted=args.weighted)
         genderG = network_creator.createGenderNetwork()
 
         # Phase Final: output results in a nice format
         base_name = os.path.basename(args.book).split('.')[0]
+        out_formatter.outputNetworkMetrics(conversationG, cooccurrenceG, goldConversationG, genderG, args.out, base_name)
         out_formatter.outputThreeNetworks(conversationG, cooccurrenceG, goldConversationG, args.out, base_name)
         out_formatter.outputGender(genderG, args.out, base_name)
         out_formatter.outputCharacters(characters, args.out, base_name)
+        if args.dynamic:
+            frames = network_creator.createDynamicNetworks(args.dynamic, args.step, args.window, args.weighted)
+            out_formatter.outputDynamicNetworks(frames, args.out, base_name)
         
         
-    elif args.action == 'collect':
+    elif args.action == 'serial':
         annotator = annotation.Annotator()
+        docs = loadDocs(args.book, annotator.nlp.vocab) if os.path.exists(args.book) else []
+        novel = serial_processing.SerialNovel(annotator, docs, args.model, args.maxprob, args.removelimit)
+        novel.addChapter(text_preproc.getPars(args.chapter))
         
-        for root, dirs, files in os.walk(args.path):
-            for file in files:
-                if not 'txt' == file.split('.')[-1]:
-                    continue
-                if file.split('.')[0] + '.weights' in files:
-                    continue
-                logging.info("Collecting data from file {}".format(os.path.join(args.path, file)))
-                out_file = os.path.join(root, file.split('.')[0] + '.weights')
-                paragraphs = text_preproc.getPars(os.path.join(root, file))
-                docs = annotator.annotate(paragraphs)
-                character_extractor = character_extraction.CharacterExtractor(docs)
-                character_extractor.saveWeights(out_file)
-                logging.info("Weights saved to file {}".format(out_file))
-                
-                if not args.nosave:
-                    doc_bin = DocBin(store_user_data=True, docs=docs)
-                    doc_file = os.path.join(root, file.split('.')[0] + '.docbin')
-                    doc_bin.to_disk(doc_file)
-                    logging.info("Annotated docs saved to file {}".format(doc_file))
+        saveDocs(novel.docs, args.book)
+        logging.info("Annotated docs saved to {}".format(args.book))
+        
+        conversationG, cooccurrenceG = novel.createNetworks()
+        base_name = os.path.basename(args.book).split('.')[0]
+        out_formatter.outputNetworkMetrics(cooccurrenceG, conversationG, None, None, args.out, base_name)
+        out_formatter.outputThreeNetworks(cooccurrenceG, conversationG, None, args.out, base_name)
+        out_formatter.outputCharacters(novel.characters, args.out, base_name)
+        return
+    
+    elif args.action == 'collect':
+        collectBooks(args.path, args.nosave, args.jobs)
         return
     
     elif args.action == 'train':
-        model.trainModel(args.path, args.out)
+        if args.cv:
+            fold_metrics, pooled_metrics = model.crossValidate(args.path, args.jobs)
+            print("\nLeave-one-book-out cross-validation")
+            model.printCrossValidation(fold_metrics, pooled_metrics)
+        elif args.benchmark:
+            results = model.benchmarkStreaming(args.path, sorted(set([1.0, 0.3, args.negratio]), reverse=True), args.batchsize, args.epochs)
+            print("\nFull batch vs. streamed training, evaluated on every fifth book")
+            model.printBenchmark(results)
+        else:
+            model.trainModel(args.path, args.out, stream=args.stream, negative_ratio=args.negratio, batch_size=args.batchsize, epochs=args.epochs)
+        return
+    
+    elif args.action == 'export':
+        model.exportModel(args.model, args.out)
         return
         
     elif args.action == 'evaluate':
@@ -167,6 +358,37 @@ character id, character name, characted gender""")
             print("Accuracy: {:.2f}".format(100*accuracy))
             return
         
+        elif args.type == 'sieves':
+            if not args.goldxml:
+                print("goldxml argument required for evaluation of sieves!")
+                return
+            docs = annotation.FalseAnnotator().annotate(args.file)
+            
+            if args.goldcharacters:
+                characters = character_evaluation.CharacterEvaluator.parseCharGender(args.goldcharacters)
+                character_extractor = character_extraction.FalseCharacterExtractor(docs, characters)
+            else:
+                character_extractor = character_extraction.CharacterExtractor(docs)
+            characters = character_extractor.extractCharacters(args.model, args.maxprob, args.removelimit)
+            
+            configs = sieve_ablation.loadConfigurations(args.configs) if args.configs else sieve_ablation.defaultConfigurations()
+            results = sieve_ablation.runAblation(docs, characters, args.goldxml, configs, args.jobs)
+            print("\nQuote attribution with {} sieve configurations".format(len(configs)))
+            sieve_ablation.printResults(results)
+            return
+        
+        elif args.type == 'cuts':
+            docs = annotation.FalseAnnotator().annotate(args.file)
+            evaluator = cut_evaluation.CutEvaluator(docs, args.model, args.maxprob, args.removelimit)
+            results = evaluator.evaluate()
+            print("\nCutting conflicting names -- shortest paths vs. spanning tree")
+            evaluator.printResults(results)
+            
+            results = evaluator.compareSettings()
+            print("\nExtracting characters for several settings at once vs. one by one")
+            evaluator.printSettingsResults(results)
+            return
+        
         elif args.type == 'characters':
             if not args.goldcharacters:
                 print("goldcharacters argument required for evaluation of characters!")
@@ -1,11 +1,22 @@
 import networkx as nx
 import logging
+import heapq
 from collections import Counter
+import numpy as np
+from spacy.tokens import Doc
+
+import annotation.novel
 
 class NetworkCreator:
-    def __init__(self, docs, characters):
+    def __init__(self, docs, characters, novel=None):
+        """
+        Args:
+            novel: Novel with the token columns of docs, created if not given
+        """
         self.docs = docs
         self.characters = characters
+        self.novel = annotation.novel.Novel(docs) if novel == None else novel
+        self.docs_counted = False
         
         self.name_dict = {}
         for char_id, (variants, gender) in self.characters.items():
@@ -15,9 +26,58 @@ class NetworkCreator:
         return
     
     
+    def countDocs(self):
+        """
+        Counts everything the networks read from the docs in one pass over
+        them, on first use; the speakers must be attributed before:
+        
+            conversation_docs       [((A, B), i)] for each doc i whose speaker
+                                    follows another speaker of doc i-1, A > B
+            gold_conversation_docs  the same for the gold speakers
+            conversation_weights    {(A, B): number of conversations}, A > B
+            gold_conversation_weights   the same for the gold speakers
+            speaking_counts         {char_id: number of docs it speaks}
+            gold_speaker_counts     {gold speaker: number of docs it speaks}
+            gold_mapping            {gold speaker: matched char_id}
+        
+        The gold speakers are read only if the docs have them, see
+        QuotesEvaluator. The co-occurrences are counted from the token
+        columns of the novel instead, see Cooccurrences.
+        """
+        if self.docs_counted:
+            return
+        has_gold = Doc.has_extension('gold_speaker')
+        self.conversation_docs, self.gold_conversation_docs = [], []
+        self.speaking_counts, self.gold_speaker_counts = Counter(), Counter()
+        self.gold_mapping = {}
+        
+        prev_speaker, prev_gold_speaker = None, None
+        for i, doc in enumerate(self.docs):
+            speaker = doc._.speaker_id
+            if not speaker == None:
+                self.speaking_counts[speaker] += 1
+                if (not prev_speaker == None) and (not speaker == prev_speaker):
+                    self.conversation_docs.append(((max(speaker, prev_speaker), min(speaker, prev_speaker)), i))
+            prev_speaker = speaker
+            
+            if has_gold:
+                gold_speaker = doc._.gold_speaker
+                if not gold_speaker == None:
+                    self.gold_speaker_counts[gold_speaker] += 1
+                    if (not prev_gold_speaker == None) and (not gold_speaker == prev_gold_speaker):
+                        self.gold_conversation_docs.append(((max(gold_speaker, prev_gold_speaker), min(gold_speaker, prev_gold_speaker)), i))
+                if not doc._.gold_match_id == None:
+                    self.gold_mapping[gold_speaker] = doc._.gold_match_id
+                prev_gold_speaker = gold_speaker
+        
+        self.conversation_weights = Counter(key for key, i in self.conversation_docs)
+        self.gold_conversation_weights = Counter(key for key, i in self.gold_conversation_docs)
+        self.docs_counted = True
+    
+    
     def createGenderNetwork(self):
         logging.info('Creating gender network...')
-        G = self.initGraph()
+        G = self.initGraph(network='gender')
         G = self.addConversationEdges(G)
         G = self.reduceGenderCharacters(G)
         G = self.renameNodes(G)
@@ -25,19 +85,23 @@ class NetworkCreator:
         return G
     
         
-    def createNetworks(self, golden_speakers=False, node_descriptions=False):
+    def createNetworks(self, golden_speakers=False, node_descriptions=False, window='paragraph', weighted=False):
+        """
+        Args:
+            window, weighted: the co-occurrences counted, see Cooccurrences
+        """
         logging.info('Creating interaction networks...')
-        conversationG = self.initGraph()
-        cooccurrenceG = self.initGraph()
+        conversationG = self.initGraph(network='conv')
+        cooccurrenceG = self.initGraph(network='cooc')
         if golden_speakers:
-            goldConversationG = self.initGraph(gold=True)
+            goldConversationG = self.initGraph(gold=True, network='gold')
         else:
             goldConversationG = None
         
     
         conversationG = self.addConversationEdges(conversationG)
         #self.reweightNodes(conversationG)
-        cooccurrenceG = self.addCooccurenceEdges(cooccurrenceG)
+        cooccurrenceG = self.addCooccurenceEdges(cooccurrenceG, window, weighted)
         if golden_speakers:
             goldConversationG = self.addConversationEdges(goldConversationG, gold=True)
         
@@ -57,8 +121,88 @@ class NetworkCreator:
         return conversationG, cooccurrenceG, goldConversationG
         
     
-    def initGraph(self, gold=False):
-        G = nx.Graph()
+    def createNetworksFromWeights(self, conversation_weights, cooccurrence_weights):
+        """
+        Creates the conversation and co-occurrence networks from edge weights
+        counted elsewhere, e.g. updated chapter by chapter in a SerialNovel.
+        
+        Args:
+            conversation_weights, cooccurrence_weights: {(char_id_A, char_id_B): weight}
+                with char_id_A > char_id_B
+        """
+        conversationG = self.addWeights(self.initGraph(network='conv'), conversation_weights)
+        cooccurrenceG = self.addWeights(self.initGraph(network='cooc'), cooccurrence_weights)
+        
+        conversationG, cooccurrenceG, _ = self.reduceCharacters(conversationG, cooccurrenceG)
+        return self.renameNodes(conversationG), self.renameNodes(cooccurrenceG)
+    
+    
+    def createDynamicNetworks(self, size, step=None, window='paragraph', weighted=False):
+        """
+        Creates the conversation and co-occurrence networks of windows of
+        size docs, step docs apart (size by default), the last one ending
+        with the last doc.
+        
+        The edge weights of each doc are counted once: a conversation edge
+        belongs to the doc of the second speaker, a co-occurrence to the doc
+        of the later mention. The weights of a window are updated from the
+        previous one by adding the docs entering it and subtracting the docs
+        leaving it.
+        
+        Args:
+            window, weighted: the co-occurrences counted, see Cooccurrences
+        
+        Yields:
+            (first doc, end doc, conversation weights, co-occurrence weights)
+            with weights {(A, B): weight}, A > B, of the non-zero edges
+        """
+        step = size if step == None else step
+        n = len(self.docs)
+        
+        doc_edges = [([], []) for _ in range(n)]
+        for (A, B), i in self.conversationDocs():
+            doc_edges[i][0].append(((A, B), 1))
+        cooccurrences = Cooccurrences(self.novel)
+        (left, right, weights) = cooccurrences.mentionPairs(window, weighted)
+        characters = cooccurrences.characters[cooccurrences.mention_chars]
+        (a, b) = (characters[left].tolist(), characters[right].tolist())
+        docs = cooccurrences.paragraphs[right].tolist()
+        weights = [1] * len(docs) if weights is None else weights.tolist()
+        for A, B, i, weight in zip(a, b, docs, weights):
+            if not A == B and A in self.characters and B in self.characters:
+                doc_edges[i][1].append(((max(A, B), min(A, B)), weight))
+        
+        conversation, cooccurrence = Counter(), Counter()
+        (first, end) = (0, 0)
+        while True:
+            last = min(first + size, n)
+            for i in range(max(end, first), last):
+                self.addDocEdges(conversation, cooccurrence, doc_edges[i], 1)
+            end = last
+            yield first, last, dict(conversation), dict(cooccurrence)
+            if last >= n:
+                break
+            for i in range(first, min(first + step, end)):
+                self.addDocEdges(conversation, cooccurrence, doc_edges[i], -1)
+            first += step
+    
+    def addDocEdges(self, conversation, cooccurrence, edges, sign):
+        for weights, doc_edges in zip((conversation, cooccurrence), edges):
+            for key, weight in doc_edges:
+                weights[key] += sign * weight
+                # edges subtracted to 0 are removed, weighted co-occurrences up to rounding
+                if sign < 0 and abs(weights[key]) < 1e-9:
+                    del weights[key]
+    
+    
+    def initGraph(self, gold=False, network=None):
+        """
+        Args:
+            network: the kind of the network saved in G.graph['network'],
+                'conv', 'cooc', 'gold' or 'gender', checked by out_formatter
+        """
+        self.countDocs()
+        G = nx.Graph(network=network)
         nodes = {}
         
         if not gold:
@@ -77,45 +221,52 @@ class NetworkCreator:
                     if is_narrator and not most_common_name:
                         most_common_name = "(THE NARRATOR)"
                 nodes[char_id] = (most_common_name, gender, total_count)
-            G.add_nodes_from([(char_id, {'name': name, 'gender': gender, 'count': count, 'char_id':char_id}) for char_id, (name, gender, count) in nodes.items()])
+            G.add_nodes_from([(char_id, {'name': name, 'gender': gender, 'count': count, 'char_id':char_id, 'speaking': self.speaking_counts[char_id]}) for char_id, (name, gender, count) in nodes.items()])
         
         else:
-            all_characters = {}
-            self.gold_mapping = {}
-            for doc in self.docs:
-                if not doc._.gold_speaker == None:  
-                    sp = doc._.gold_speaker
-                    if sp in all_characters:
-                        all_characters[sp] += 1
-                    else:
-                        all_characters[sp] = 1
-                if not doc._.gold_match_id == None:
-                    self.gold_mapping[doc._.gold_speaker] = doc._.gold_match_id
-            
-            G.add_nodes_from([(name, {'name': name, 'char_id': self.gold_mapping[name] if name in self.gold_mapping else None, 'count': count}) for name, count in all_characters.items()])
+            G.add_nodes_from([(name, {'name': name, 'char_id': self.gold_mapping[name] if name in self.gold_mapping else None, 'count': count}) for name, count in self.gold_speaker_counts.items()])
         
-        for A in G.nodes:  
-            for B in G.nodes:
-                if A > B:
-                    G.add_edge(A, B, weight=0)
         return G
     
     
-    def addConversationEdges(self, G, gold=False):
-        prev_speaker = None
-        for doc in self.docs:
+    def addWeights(self, G, weights):
+        """
+        Adds the edges with a non-zero weight between nodes of G.
         
-            if not gold:
-                speaker = doc._.speaker_id
-            else:
-                speaker = doc._.gold_speaker
-            
-            if (not speaker == None) and (not prev_speaker == None) and (not speaker == prev_speaker):
-                G[prev_speaker][speaker]['weight'] += 1
-            prev_speaker = speaker
+        Args:
+            weights: {(A, B): weight} with A > B
         
+        The edges are added in the order of their nodes in G, the order in
+        which a complete graph would have them.
+        """
+        order = dict((node, k) for k, node in enumerate(G.nodes))
+        edges = [(A, B, weight) for (A, B), weight in weights.items() if weight and A in order and B in order]
+        edges.sort(key=lambda edge: (order[edge[0]], order[edge[1]]))
+        G.add_weighted_edges_from(edges)
         return G
     
+    
+    def addConversationEdges(self, G, gold=False):
+        return self.addWeights(G, self.countConversations(gold))
+    
+    def countConversations(self, gold=False):
+        """
+        Returns:
+            {(A, B): number of times A and B speak one after the other}, A > B
+        """
+        self.countDocs()
+        return Counter(self.gold_conversation_weights if gold else self.conversation_weights)
+    
+    def conversationDocs(self, gold=False):
+        """
+        Yields:
+            ((A, B), i) for each doc i whose speaker follows another speaker
+            of doc i-1, A > B
+        """
+        self.countDocs()
+        for key, i in (self.gold_conversation_docs if gold else self.conversation_docs):
+            yield key, i
+    
     def reweightNodes(self, G):
         node_weights = {}
         for n, data in G.nodes(data=True):
@@ -126,25 +277,20 @@ class NetworkCreator:
         for n, data in G.nodes(data=True):
             data['count'] = node_weights[n]
     
-    def addCooccurenceEdges(self, G):
-        for doc in self.docs:
-            this_characters = set()
-            for token in doc:
-                if not token._.char_id == None:
-                    this_characters.add(token._.char_id)
-            for A in this_characters:
-                for B in this_characters:
-                    if A > B:
-                        G[A][B]['weight'] += 1
-        return G
+    def addCooccurenceEdges(self, G, window='paragraph', weighted=False):
+        return self.addWeights(G, self.countCooccurrences(window, weighted))
     
-    def reduceGenderCharacters(self, G):
-        edges_to_remove = []
-        for u, v, weight in G.edges.data('weight'):
-            if weight == 0:
-                edges_to_remove.append((u, v))
-        G.remove_edges_from(edges_to_remove)
+    def countCooccurrences(self, window='paragraph', weighted=False):
+        """
+        Args:
+            window: 'paragraph', 'sentence' or a number of tokens, see Cooccurrences
         
+        Returns:
+            {(A, B): weight of the co-occurrences of A and B}, A > B
+        """
+        return Cooccurrences(self.novel).count(window, weighted)
+    
+    def reduceGenderCharacters(self, G):
         nodes_to_remove = []
         for c in nx.connected_components(G):
             if len(c) == 1:
@@ -152,51 +298,32 @@ class NetworkCreator:
         if len(nodes_to_remove) < len(G.nodes):
             G.remove_nodes_from(nodes_to_remove)
         
-        most_frequent_characters = Counter()
-        for node, data in G.nodes(data=True):
-            most_frequent_characters += Counter({node: data['count'] + 1})
-        most_frequent_characters = Counter(most_frequent_characters).most_common()
-        if len(most_frequent_characters) > 20:
-            nodes_to_remove = [n for (n, c) in most_frequent_characters[20:]]
-            G.remove_nodes_from(nodes_to_remove)
+        G.remove_nodes_from(self.lessFrequentCharacters(G))
         return G
+    
+    def lessFrequentCharacters(self, G, limit=20):
+        """
+        Returns:
+            the nodes of G not among the limit nodes with the highest count,
+            ties in the order of the nodes
+        """
+        if len(G.nodes) <= limit:
+            return []
+        kept = set(heapq.nlargest(limit, G.nodes, key=lambda node: G.nodes[node]['count']))
+        return [node for node in G.nodes if not node in kept]
         
         
     
     def reduceCharacters(self, convG, coocG, goldG=None):
-        edges_to_remove = []
-        for u, v, weight in convG.edges.data('weight'):
-            if weight == 0:
-                edges_to_remove.append((u, v))
-        convG.remove_edges_from(edges_to_remove)
-        
-        edges_to_remove = []
-        for u, v, weight in coocG.edges.data('weight'):
-            if weight == 0:
-                edges_to_remove.append((u, v))
-        coocG.remove_edges_from(edges_to_remove)
-        
         if not goldG:
-            most_frequent_characters = Counter()
-            for node, data in convG.nodes(data=True):
-                most_frequent_characters += Counter({node: data['count'] + 1})
-            most_frequent_characters = Counter(most_frequent_characters).most_common()
-            if len(most_frequent_characters) > 20:
-                nodes_to_remove = [n for (n, c) in most_frequent_characters[20:]]
-                convG.remove_nodes_from(nodes_to_remove)
-                coocG.remove_nodes_from(nodes_to_remove)
+            nodes_to_remove = self.lessFrequentCharacters(convG)
+            convG.remove_nodes_from(nodes_to_remove)
+            coocG.remove_nodes_from(nodes_to_remove)
         
         if goldG:
             nodes_to_remove = [node for node, data in goldG.nodes(data=True) if data['char_id'] == None]
             goldG.remove_nodes_from(nodes_to_remove)
             
-            edges_to_remove = []
-            for u, v, weight in goldG.edges.data('weight'):
-                if weight == 0:
-                    edges_to_remove.append((u, v))
-            goldG.remove_edges_from(edges_to_remove)
-            
-            
             remaining_nodes = [data['char_id'] for _, data in goldG.nodes(data=True)]
             nodes_to_remove = [node for node in convG.nodes if not node in remaining_nodes]
             convG.remove_nodes_from(nodes_to_remove)
@@ -235,3 +362,122 @@ class NetworkCreator:
             pass
         return G
     
+
+
+class Cooccurrences:
+    """
+    Co-occurrences of characters counted from one array of all their
+    mentions (tokens with a char_id) over the whole novel, ordered by
+    position, with the paragraph and the sentence of each mention.
+    
+    Two characters co-occur in a paragraph or a sentence mentioning both of
+    them, or when two of their mentions are at most k tokens apart. The
+    pairs of mentions in the same group or window are made with NumPy for
+    all groups at once and counted with np.unique.
+    """
+    def __init__(self, novel):
+        self.positions = np.flatnonzero(novel.char_id != novel.NO_CHARACTER)
+        # char_ids of the mentions as indexes to the sorted characters
+        self.characters, self.mention_chars = np.unique(novel.char_id[self.positions], return_inverse=True)
+        self.paragraphs = np.searchsorted(novel.offsets, self.positions, side='right') - 1
+        
+        # every doc starts a sentence, also a doc with no sentences
+        sent_starts = novel.sent_start == 1
+        sent_starts[novel.offsets[:-1][novel.offsets[:-1] < len(sent_starts)]] = True
+        self.sentences = (np.cumsum(sent_starts) - 1)[self.positions]
+    
+    def byParagraph(self):
+        """
+        Returns:
+            {(A, B): number of paragraphs mentioning both A and B}, A > B
+        """
+        return self.count('paragraph')
+    
+    def bySentence(self):
+        """
+        Returns:
+            {(A, B): number of sentences mentioning both A and B}, A > B
+        """
+        return self.count('sentence')
+    
+    def byWindow(self, k, weighted=False):
+        """
+        Counts the pairs of mentions of two characters at most k tokens
+        apart, across paragraphs too.
+        
+        Args:
+            weighted: a pair d tokens apart adds (k + 1 - d) / (k + 1)
+                instead of 1
+        
+        Returns:
+            {(A, B): weight}, A > B
+        """
+        return self.count(k, weighted)
+    
+    def count(self, window='paragraph', weighted=False):
+        (left, right, weights) = self.mentionPairs(window, weighted)
+        return self.countPairs(self.mention_chars[left], self.mention_chars[right], weights)
+    
+    def mentionPairs(self, window='paragraph', weighted=False):
+        """
+        Args:
+            window: 'paragraph', 'sentence' or a number of tokens k
+        
+        Returns:
+            (left, right, weights): the indexes of the pairs of co-occurring
+            mentions, left before right, and their weights, None unless
+            weighted with a number of tokens
+        """
+        if window == 'paragraph':
+            return self.groupPairs(self.paragraphs) + (None,)
+        if window == 'sentence':
+            return self.groupPairs(self.sentences) + (None,)
+        
+        k = int(window)
+        ends = np.searchsorted(self.positions, self.positions + k, side='right')
+        (left, right) = self.pairs(ends)
+        weights = None
+        if weighted:
+            weights = (k + 1 - (self.positions[right] - self.positions[left])) / (k + 1)
+        return left, right, weights
+    
+    def groupPairs(self, groups):
+        """
+        Returns:
+            (left, right): the pairs of the first mentions of the characters
+            in each group
+        """
+        n_chars = len(self.characters)
+        # sorted by group and character
+        keys, firsts = np.unique(groups * n_chars + self.mention_chars, return_index=True)
+        group_of = keys // n_chars
+        (left, right) = self.pairs(np.searchsorted(group_of, group_of, side='right'))
+        return firsts[left], firsts[right]
+    
+    def pairs(self, ends):
+        """
+        Returns:
+            (left, right): all pairs of indexes left < right < ends[left]
+        """
+        counts = np.maximum(ends - np.arange(len(ends)) - 1, 0)
+        left = np.repeat(np.arange(len(ends)), counts)
+        firsts = np.cumsum(counts) - counts
+        right = left + 1 + np.arange(len(left)) - np.repeat(firsts, counts)
+        return left, right
+    
+    def countPairs(self, a, b, weights=None):
+        """
+        Returns:
+            {(A, B): number or sum of weights of the pairs}, A > B, for the
+            pairs (a, b) of character indexes of different characters
+        """
+        different = a != b
+        (a, b) = (a[different], b[different])
+        n_chars = len(self.characters)
+        keys, inverse = np.unique(np.maximum(a, b) * n_chars + np.minimum(a, b), return_inverse=True)
+        if weights is None:
+            counts = np.bincount(inverse, minlength=len(keys)).tolist()
+        else:
+            counts = np.bincount(inverse, weights=weights[different], minlength=len(keys)).tolist()
+        characters = self.characters.tolist()
+        return dict(((characters[key // n_chars], characters[key % n_chars]), count) for key, count in zip(keys.tolist(), counts))
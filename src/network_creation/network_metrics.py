@@ -0,0 +1,321 @@
+"""
+Metrics of the character networks, computed on a sparse adjacency of the
+graph made once from the networkx graph:
+
+    degree          number of neighbours and the sum of the edge weights
+    pagerank        weighted PageRank, by sparse power iteration
+    eigenvector     weighted eigenvector centrality, by sparse power iteration
+    betweenness     weighted betweenness centrality (Brandes), an edge of
+                    weight w being 1/w long; from a sample of the nodes in
+                    graphs with more nodes than the sample
+    community       Louvain communities maximizing the weighted modularity
+
+The metrics of a graph are cached in a json file named by the hash of the
+nodes, edges and weights of the graph and the parameters of the metrics, so
+an unchanged network is not computed again.
+"""
+
+import os
+import json
+import heapq
+import hashlib
+import logging
+
+import numpy as np
+
+# the version of the metrics, part of the cache key
+METRICS_VERSION = 1
+
+
+class SparseGraph:
+    """
+    Undirected weighted graph as arrays of its directed edges, both
+    directions of every edge, sorted by source node:
+
+        sources, targets    indexes of the nodes of the edges
+        weights             weights of the edges
+        indptr              the edges of node i are indptr[i]:indptr[i+1]
+
+    Self loops are stored once, with twice their weight.
+    """
+    def __init__(self, n, u, v, w):
+        self.n = n
+        loops = u == v
+        sources = np.concatenate([u, v[~loops]])
+        targets = np.concatenate([v, u[~loops]])
+        weights = np.concatenate([np.where(loops, 2 * w, w), w[~loops]]).astype(np.float64)
+        order = np.lexsort((targets, sources))
+        self.sources, self.targets, self.weights = sources[order], targets[order], weights[order]
+        self.indptr = np.searchsorted(self.sources, np.arange(n + 1))
+
+    @staticmethod
+    def fromNetwork(G):
+        """
+        Returns:
+            (SparseGraph, nodes): the graph of the edges of G with their
+            weights (1 if missing), nodes in the order of G
+        """
+        nodes = list(G.nodes)
+        index = dict((node, i) for i, node in enumerate(nodes))
+        edges = [(index[a], index[b], data.get('weight', 1)) for a, b, data in G.edges(data=True)]
+        u = np.array([a for a, _, _ in edges], dtype=np.int64)
+        v = np.array([b for _, b, _ in edges], dtype=np.int64)
+        w = np.array([weight for _, _, weight in edges], dtype=np.float64)
+        return SparseGraph(len(nodes), u, v, w), nodes
+
+    def multiply(self, x):
+        """
+        Returns:
+            A x for the weighted adjacency matrix A
+        """
+        return np.bincount(self.sources, weights=self.weights * x[self.targets], minlength=self.n)
+
+    def degrees(self):
+        return np.diff(self.indptr)
+
+    def strengths(self):
+        """
+        Returns:
+            the sum of the weights of the edges of each node
+        """
+        return np.bincount(self.sources, weights=self.weights, minlength=self.n)
+
+    def pageRank(self, alpha=0.85, tol=1e-6, max_iter=100):
+        if self.n == 0:
+            return np.zeros(0)
+        strengths = self.strengths()
+        dangling = strengths == 0
+        out = np.divide(1.0, strengths, out=np.zeros(self.n), where=~dangling)
+        x = np.full(self.n, 1.0 / self.n)
+        for _ in range(max_iter):
+            last = x
+            x = alpha * self.multiply(last * out) + (alpha * last[dangling].sum() + 1 - alpha) / self.n
+            if np.abs(x - last).sum() < self.n * tol:
+                break
+        return x
+
+    def eigenvector(self, tol=1e-6, max_iter=100):
+        """
+        Power iteration with A + I, which has the same leading eigenvector
+        and does not oscillate on bipartite graphs.
+        """
+        if self.n == 0:
+            return np.zeros(0)
+        x = np.full(self.n, 1.0 / self.n)
+        for _ in range(max_iter):
+            last = x
+            x = last + self.multiply(last)
+            x /= np.linalg.norm(x)
+            if np.abs(x - last).sum() < self.n * tol:
+                break
+        return x
+
+    def betweenness(self, sources=None):
+        """
+        Brandes' algorithm with Dijkstra from each source node.
+
+        Args:
+            sources: indexes of the source nodes, all nodes if None; the
+                betweenness from a sample is scaled by n / len(sources)
+
+        Returns:
+            the betweenness of each node, normalized by the number of the
+            pairs of the other nodes
+        """
+        n = self.n
+        sources = range(n) if sources is None else sources
+        lengths = 1.0 / self.weights
+        (indptr, targets) = (self.indptr.tolist(), self.targets.tolist())
+        lengths = lengths.tolist()
+
+        betweenness = np.zeros(n)
+        n_sources = 0
+        for s in sources:
+            n_sources += 1
+            order, preds = [], [[] for _ in range(n)]
+            sigma = [0] * n
+            sigma[s] = 1
+            dist = {}
+            seen = {s: 0.0}
+            heap = [(0.0, 0, s, s)]
+            counter = 1
+            while heap:
+                (d, _, pred, v) = heapq.heappop(heap)
+                if v in dist:
+                    continue
+                sigma[v] += sigma[pred] if not pred == v else 0
+                order.append(v)
+                dist[v] = d
+                for k in range(indptr[v], indptr[v+1]):
+                    t = targets[k]
+                    vt = d + lengths[k]
+                    if not t in dist and (not t in seen or vt < seen[t]):
+                        seen[t] = vt
+                        heapq.heappush(heap, (vt, counter, v, t))
+                        counter += 1
+                        sigma[t] = 0
+                        preds[t] = [v]
+                    elif vt == seen[t]:
+                        sigma[t] += sigma[v]
+                        preds[t].append(v)
+
+            delta = [0.0] * n
+            for w in reversed(order):
+                for v in preds[w]:
+                    delta[v] += sigma[v] / sigma[w] * (1 + delta[w])
+                if not w == s:
+                    betweenness[w] += delta[w]
+
+        if n > 2 and n_sources:
+            # each shortest path is counted from both of its ends
+            betweenness *= n / n_sources / ((n - 1) * (n - 2))
+        return betweenness
+
+    def louvain(self):
+        """
+        Louvain method: moves each node to the community of a neighbour
+        with the largest modularity gain until no node moves, then merges
+        the communities to nodes of a new graph and repeats. The nodes are
+        visited in their order, so the communities are deterministic.
+
+        Returns:
+            (communities, modularity): the community of each node, numbered
+            in the order of their first node
+        """
+        communities = np.arange(self.n)
+        graph = self
+        while True:
+            level = graph.moveNodes()
+            n_level = level.max() + 1 if len(level) else 0
+            if n_level == graph.n:
+                break
+            communities = level[communities]
+            keys = level[graph.sources] * n_level + level[graph.targets]
+            keys, inverse = np.unique(keys, return_inverse=True)
+            weights = np.bincount(inverse, weights=graph.weights)
+            (u, v) = (keys // n_level, keys % n_level)
+            upper = u <= v
+            # the weights of both directions of an edge, halved back for the loops
+            graph = SparseGraph(n_level, u[upper], v[upper], np.where(u[upper] == v[upper], weights[upper] / 2, weights[upper]))
+
+        _, first, communities = np.unique(communities, return_index=True, return_inverse=True)
+        communities = np.argsort(np.argsort(first))[communities]
+        return communities, self.modularity(communities)
+
+    def moveNodes(self):
+        """
+        Returns:
+            the community of each node after the local moves, numbered 0..k-1
+        """
+        n = self.n
+        strengths = self.strengths().tolist()
+        m2 = sum(strengths)
+        communities = list(range(n))
+        if m2 == 0:
+            return np.arange(n)
+        totals = list(strengths)
+        (indptr, targets, weights) = (self.indptr.tolist(), self.targets.tolist(), self.weights.tolist())
+
+        moved = True
+        while moved:
+            moved = False
+            for i in range(n):
+                old = communities[i]
+                totals[old] -= strengths[i]
+                links = {old: 0.0}
+                for k in range(indptr[i], indptr[i+1]):
+                    if not targets[k] == i:
+                        c = communities[targets[k]]
+                        links[c] = links.get(c, 0.0) + weights[k]
+                (best, best_gain) = (old, links[old] - totals[old] * strengths[i] / m2)
+                for c, link in links.items():
+                    gain = link - totals[c] * strengths[i] / m2
+                    if gain > best_gain + 1e-12:
+                        (best, best_gain) = (c, gain)
+                totals[best] += strengths[i]
+                communities[i] = best
+                if not best == old:
+                    moved = True
+        return np.unique(communities, return_inverse=True)[1]
+
+    def modularity(self, communities):
+        m2 = self.weights.sum()
+        if m2 == 0:
+            return 0.0
+        internal = self.weights[communities[self.sources] == communities[self.targets]].sum()
+        totals = np.bincount(communities, weights=self.strengths())
+        return float(internal / m2 - ((totals / m2) ** 2).sum())
+
+
+def graphHash(G, parameters):
+    """
+    Returns:
+        sha1 hex digest of the nodes and their char_ids, the weighted edges
+        of G and the parameters
+    """
+    nodes = sorted([str(node), str(data.get('char_id'))] for node, data in G.nodes(data=True))
+    edges = sorted(sorted([str(a), str(b)]) + [repr(float(data.get('weight', 1)))] for a, b, data in G.edges(data=True))
+    content = json.dumps([METRICS_VERSION, nodes, edges, parameters], sort_keys=True)
+    return hashlib.sha1(content.encode('utf-8')).hexdigest()
+
+
+def computeMetrics(G, betweenness_samples=100, seed=0):
+    """
+    Args:
+        betweenness_samples: the betweenness of a graph with more nodes is
+            computed from this many random source nodes
+
+    Returns:
+        {'nodes': {node: {'char_id', 'degree', 'strength', 'pagerank',
+        'eigenvector', 'betweenness', 'community'}}, 'degree_distribution':
+        [[degree, number of nodes]], 'communities', 'modularity',
+        'betweenness_sources'}
+    """
+    graph, nodes = SparseGraph.fromNetwork(G)
+    sources = None
+    if graph.n > betweenness_samples:
+        sources = np.sort(np.random.default_rng(seed).choice(graph.n, betweenness_samples, replace=False)).tolist()
+
+    degrees = graph.degrees()
+    columns = {
+        'degree': degrees.tolist(),
+        'strength': graph.strengths().tolist(),
+        'pagerank': graph.pageRank().tolist(),
+        'eigenvector': graph.eigenvector().tolist(),
+        'betweenness': graph.betweenness(sources).tolist(),
+    }
+    communities, modularity = graph.louvain()
+    columns['community'] = communities.tolist()
+
+    values, counts = np.unique(degrees, return_counts=True)
+    return {
+        'nodes': dict((str(node), dict([('char_id', G.nodes[node].get('char_id'))] + [(name, column[i]) for name, column in columns.items()]))
+                      for i, node in enumerate(nodes)),
+        'degree_distribution': [[int(value), int(count)] for value, count in zip(values, counts)],
+        'communities': int(communities.max()) + 1 if len(communities) else 0,
+        'modularity': modularity,
+        'betweenness_sources': graph.n if sources is None else len(sources),
+    }
+
+
+def cachedMetrics(G, cache_dir, betweenness_samples=100, seed=0):
+    """
+    Returns the metrics of G from cache_dir/<hash>.json, computed and saved
+    there first unless the graph was seen before.
+    """
+    key = graphHash(G, {'betweenness_samples': betweenness_samples, 'seed': seed})
+    cache_file = os.path.join(cache_dir, key + '.json')
+    if os.path.exists(cache_file):
+        logging.info('Network metrics loaded from {}'.format(cache_file))
+        with open(cache_file) as f:
+            return json.load(f)
+
+    metrics = computeMetrics(G, betweenness_samples, seed)
+    if not os.path.exists(cache_dir):
+        os.makedirs(cache_dir)
+    # written to a temporary file first, so an interrupted run never leaves a partial file behind
+    tmp_file = cache_file + '.tmp{}'.format(os.getpid())
+    with open(tmp_file, 'w') as f:
+        json.dump(metrics, f)
+    os.replace(tmp_file, cache_file)
+    return metrics
@@ -4,6 +4,10 @@ import pickle
 import os
 import math
 import logging
+import json
+import sys
+
+import network_creation.network_metrics as network_metrics
 
 MAX_EDGE_WEIGHT = 20
 MAX_NODE_WEIGHT = 3000
@@ -70,6 +74,8 @@ def outputThreeNetworks(cooc, conv, gold, outdir, orig_name=''):
     if not os.path.exists(outdir):
         os.makedirs(outdir)
     
+    for name, G in [('cooc', cooc), ('conv', conv), ('gold', gold)]:
+        checkNetwork(G, name)
     conv, cooc, gold = scaleEdgeWeights(conv, cooc, gold)
     conv, cooc, gold = makeNewNodeWeights(conv, cooc, gold)
     
@@ -86,6 +92,39 @@ def outputThreeNetworks(cooc, conv, gold, outdir, orig_name=''):
         outputNetwork(gold, nodelist, pos, os.path.join(outdir, prefix + 'gold.pdf'), (1,.47,.35))
     return
 
+def outputNetworkMetrics(cooc, conv, gold, gender, outdir, orig_name=''):
+    """
+    Writes the metrics of the networks (see network_metrics) next to their
+    pdfs, e.g. conv_metrics.json. Must be called before the networks are
+    drawn, which rescales their weights.
+    
+    The metrics are cached in outdir/metrics_cache by the content of the
+    networks, the metrics of an unchanged network are not computed again.
+    """
+    prefix = '' if not orig_name else orig_name + '_'
+    cache_dir = os.path.join(outdir, 'metrics_cache')
+    
+    for name, G in [('cooc', cooc), ('conv', conv), ('gold', gold), ('gender', gender)]:
+        if not G:
+            continue
+        checkNetwork(G, name)
+        metrics = network_metrics.cachedMetrics(G, cache_dir)
+        outfile = os.path.join(outdir, prefix + name + '_metrics.json')
+        with open(outfile, 'w') as f:
+            json.dump(metrics, f, indent=1)
+        logging.info('Network metrics saved to {}'.format(outfile))
+
+def checkNetwork(G, name):
+    """
+    Raises ValueError if G is a network of NetworkCreator of another kind
+    than name, e.g. the conversation network passed as the co-occurrence
+    one.
+    """
+    if G == None or G.graph.get('network') == None:
+        return
+    if not G.graph['network'] == name:
+        raise ValueError("The '{}' network was given as the '{}' network".format(G.graph['network'], name))
+
 def outputNetwork(G, nodelist, pos, outfile, color=(0.5, 0.5, 0.5)):
     plt.figure(1, figsize=(10,10))
     
@@ -181,14 +220,7 @@ def outputSpeakers(docs, characters, outdir, orig_name=''):
         os.makedirs(outdir)
     outfile = os.path.join(outdir, prefix + 'speakers.txt')
     
-    character_dict = {}
-    for char_id, (variants, gender) in characters.items():
-            best_name, best_count = None, 0
-            for name, count in variants:
-                if count > best_count:
-                    best_name = name
-                    best_count = count
-            character_dict[char_id] = best_name
+    character_dict = characterNames(characters)
     
     with open(outfile, 'w') as f:
         for doc in docs:
@@ -200,6 +232,95 @@ def outputSpeakers(docs, characters, outdir, orig_name=''):
             f.write('\n')
     logging.info('Speakers saved to {}'.format(outfile))
 
+def characterNames(characters):
+    """
+    Returns:
+        {char_id: the most frequent name}
+    """
+    character_dict = {}
+    for char_id, (variants, gender) in characters.items():
+            best_name, best_count = None, 0
+            for name, count in variants:
+                if count > best_count:
+                    best_name = name
+                    best_count = count
+            character_dict[char_id] = best_name
+    return character_dict
+
+def speakerRecord(docs, i, token_start, character_dict):
+    doc = docs[i]
+    mention = None
+    if doc._.mention:
+        (j, (start, end)) = doc._.mention
+        mention = {'paragraph': j, 'tokens': [start, end], 'text': docs[j][start:end].text}
+    speaker_id = doc._.speaker_id
+    return {
+        'paragraph': i,
+        'tokens': [token_start, token_start + len(doc)],
+        'text': doc.text,
+        'quotes': [[doc[start:end].start_char, doc[start:end].end_char] for (start, end) in doc._.quotes],
+        'mention': mention,
+        'mention_sieve': doc._.mention_sieve,
+        'speaker_id': speaker_id,
+        'speaker': None if speaker_id == None else character_dict.get(speaker_id),
+        'speaker_sieve': doc._.speaker_sieve,
+    }
+
+def outputSpeakerRecords(docs, indexes, characters, outfile):
+    """
+    Writes a json line for each doc as soon as indexes yields it, e.g. from
+    QuoteAttributor.streamSpeakers, to outfile or to the standard output for
+    '-'. A line has the paragraph index, its global token offsets and text,
+    the character offsets of its quotes in the text, the mention (paragraph
+    index, token offsets in it and text), the speaker and the sieves that
+    found them.
+    """
+    character_dict = characterNames(characters)
+    token_starts = [0]
+    for doc in docs:
+        token_starts.append(token_starts[-1] + len(doc))
+    
+    f = sys.stdout if outfile == '-' else open(outfile, 'w')
+    try:
+        for i in indexes:
+            # the attribution goes on when the reader of a pipe stops early
+            if f == None:
+                continue
+            try:
+                f.write(json.dumps(speakerRecord(docs, i, token_starts[i], character_dict), ensure_ascii=False) + '\n')
+                f.flush()
+            except BrokenPipeError:
+                logging.warning('Speakers output closed by the reader.')
+                os.dup2(os.open(os.devnull, os.O_WRONLY), f.fileno())
+                f = None
+    finally:
+        if not f == None and not f is sys.stdout:
+            f.close()
+    if not outfile == '-':
+        logging.info('Speakers saved to {}'.format(outfile))
+
+def outputDynamicNetworks(frames, outdir, orig_name=''):
+    """
+    Writes the frames of NetworkCreator.createDynamicNetworks as they are
+    created, one edge per line: the frame, its first and end paragraph, the
+    network (conv or cooc), the char_ids of the two characters and the
+    weight.
+    """
+    prefix = '' if not orig_name else orig_name + '_'
+    if not os.path.exists(outdir):
+        os.makedirs(outdir)
+    outfile = os.path.join(outdir, prefix + 'dynamic.tsv')
+    
+    with open(outfile, 'w') as f:
+        f.write('frame\tfirst\tend\tnetwork\tsource\ttarget\tweight\n')
+        for frame, (first, end, conversation, cooccurrence) in enumerate(frames):
+            for network, weights in [('conv', conversation), ('cooc', cooccurrence)]:
+                for (A, B) in sorted(weights):
+                    weight = weights[(A, B)]
+                    weight = str(weight) if isinstance(weight, int) else '{:.6g}'.format(weight)
+                    f.write('{}\t{}\t{}\t{}\t{}\t{}\t{}\n'.format(frame, first, end, network, A, B, weight))
+    logging.info('Dynamic networks saved to {}'.format(outfile))
+
 def outputCharacters(characters, outdir, orig_name=''):
     prefix = '' if not orig_name else orig_name + '_'
     if not os.path.exists(outdir):
@@ -2,12 +2,26 @@ from spacy.tokens import Doc, Span
 import json
 import logging
 import os
+import numpy as np
+
+import quote_attribution.sieve_executor
+import annotation.novel
 
 class MentionSpeaker:
-    def __init__(self, name_dict, gender_dict, docs):
+    # speakers lists count mentions this many tokens before the first quote and after the last one
+    WINDOW_BEFORE = 2000
+    WINDOW_AFTER = 500
+    
+    def __init__(self, name_dict, gender_dict, docs, window_before=WINDOW_BEFORE, window_after=WINDOW_AFTER, novel=None):
         self.name_dict = name_dict
         self.docs = docs
         self.gender_dict = gender_dict
+        self.window_before = window_before
+        self.window_after = window_after
+        self.novel = annotation.novel.Novel(docs) if novel == None else novel
+        # windows of the speakers lists and the lists made, see makeSpeakersLists
+        self.windows = {}
+        self.speakers_lists = {}
         
         self.gendered_words = {}
         vocab_dir = os.path.join(os.path.dirname(__file__), '..', '..', 'vocab')
@@ -24,86 +38,119 @@ class MentionSpeaker:
         Doc.set_extension("speakers_list_extended", default=None, force=True)
         
     
-    def solveSpeakers(self):
+    def solveSpeakers(self, start=0):
+        """
+        Finds the speakers of quotes in docs from start on.
+        """
         logging.info("Linking speakers...")
         
-        self.makeSpeakersLists()
+        self.makeSpeakersLists(start)
+        
+        executor = quote_attribution.sieve_executor.SieveExecutor(self.docs, start)
+        executor.runSpeakerSieves(self.getSieves())
         
+        return
+    
+    def getSieves(self):
         sieves = []
         sieves.append(ExactNameMatch(self.docs, self.name_dict, self.gender_dict, self.gendered_words))
         sieves.append(Coreference(self.docs, self.name_dict, self.gender_dict, self.gendered_words))
         sieves.append(ConversationalPattern(self.docs, self.name_dict, self.gender_dict, self.gendered_words))
         #sieves.append(ClosestNameBefore(self.docs, self.name_dict, self.gender_dict, self.gendered_words))
-        sieves.append(MajoritySpeaker(self.docs, self.name_dict, self.gender_dict, self.gendered_words))
-        
-        for sieve in sieves:
-            sieve()
-        
-        return
+        sieves.append(MajoritySpeaker(self.docs, self.name_dict, self.gender_dict, self.gendered_words, self.getSpeakersList))
+        return sieves
 
     
     def distance(self, left, right):
         (left_doc_i, left_tok_i) = left
         (right_doc_i, right_tok_i) = right
         
-        if left_doc_i == right_doc_i:
-            return right_tok_i - left_tok_i
-        elif left_doc_i > right_doc_i:
+        if left_doc_i > right_doc_i:
             return 0
+        offsets = self.novel.offsets
+        return int(offsets[right_doc_i] + right_tok_i - offsets[left_doc_i] - left_tok_i)
+    
+    
+    def makeSpeakersLists(self, start=0):
+        """
+        For each doc from start on containing direct speech, finds the window
+        of the list of possible speakers appearing around the doc: the
+        characters mentioned outside direct speech window_before tokens before
+        the first quote and window_after tokens after the last one.
+        
+        Mentions are kept as sorted global token positions, so the window of
+        a doc is a range of mentions found by two binary searches, done for
+        all docs at once. The lists themselves are only made by
+        getSpeakersList, for the docs that reach MajoritySpeaker.
+        """
+        (positions, self.mention_char_ids) = self.mentionPositions()
+        self.windows = {}
+        self.speakers_lists = {}
         
-        distance = 0
-        distance += len(self.docs[left_doc_i]) - left_tok_i
-        left_tok_i = 0
-        left_doc_i += 1
-        while left_doc_i < right_doc_i:
-            distance += len(self.docs[left_doc_i])
-            left_doc_i += 1
-        distance += right_tok_i
-        return distance
-    
-    
-    def makeSpeakersLists(self):
+        quote_docs, mintokens, maxtokens = [], [], []
+        offsets = self.novel.offsets
+        for i in range(start, len(self.docs)):
+            quotes = self.docs[i]._.quotes
+            if quotes:
+                quote_docs.append(i)
+                mintokens.append(offsets[i] + quotes[0][0])
+                maxtokens.append(offsets[i] + quotes[-1][1])
+        if not quote_docs:
+            return
+        # window of mention indexes [left, right) of each quote doc
+        left = np.minimum(np.searchsorted(positions, np.array(mintokens, dtype=np.int64) - self.window_before, side='left'), max(len(positions) - 1, 0))
+        right = np.searchsorted(positions, np.array(maxtokens, dtype=np.int64) + self.window_after, side='left')
+        self.windows = dict(zip(quote_docs, zip(left.tolist(), right.tolist())))
+        return
+    
+    
+    def mentionPositions(self):
         """
-        For each doc containing direct speech, creates a list of possible
-        speakers appearing around the doc.
+        Returns:
+            (positions, char_ids): the global token positions of the
+            mentions counted in the speakers lists, in order, and their
+            char_ids
         """
-        mentions = []
-        for i, doc in enumerate(self.docs):
-            # save ALL mentions:
-            for token in doc:
-                if token._.char_id and token._.char_id != -1:
-                    if not token._.is_direct_speech:
-                        mentions.append((i, token.i))
+        # save ALL mentions; char_id 0 is falsy and was never counted
+        char_ids = self.novel.char_id
+        is_mention = (char_ids != self.novel.NO_CHARACTER) & (char_ids != 0) & (char_ids != -1) & ~self.novel.is_direct_speech
+        return np.flatnonzero(is_mention), char_ids[is_mention]
+    
+    
+    def getSpeakersList(self, i):
+        """
+        Makes the speakers list of doc i on the first call after
+        makeSpeakersLists and sets doc._.speakers_list.
         
-        left, right = 0, 0
-        for i, doc in enumerate(self.docs):
-            # Make speakers list: count all coref identified ents 2000 tokens before and 500 tokens after the quote 
-            # (possibly expansion to 2000 on both sides if nothing found is not done)
-            if doc._.quotes:
-                mintoken = (i, doc._.quotes[0][0])
-                while left < len(mentions) - 1 and self.distance(mentions[left], mintoken) > 2000:
-                    left += 1
-                maxtoken = (i, doc._.quotes[-1][1])
-                while right < len(mentions) and self.distance(maxtoken, mentions[right]) < 500:
-                    right += 1
-                
-                speakers_dict = {}
-                for (mention_doc, mention_token) in mentions[left:right]:
-                    char_id = self.docs[mention_doc][mention_token]._.char_id
-                    if self.docs[mention_doc][mention_token]._.is_direct_speech:
-                        continue
-                    if char_id == -1:
-                        continue
-                    dist = 1 + (min(self.distance((mention_doc, mention_token), mintoken), self.distance((mention_doc, mention_token), maxtoken)))
-                    if char_id in speakers_dict:
-                        speakers_dict[char_id] += 1# / dist
-                    else:
-                        speakers_dict[char_id] = 1# / dist
-                speakers_list = sorted(speakers_dict.items(), key=lambda item: item[1])
-                speakers_list.reverse()
-                
-                doc._.speakers_list = speakers_list
+        Returns:
+            [(char_id, count)], the most frequent first
+        """
+        if not i in self.speakers_lists:
+            (left, right) = self.windows[i]
+            characters, firsts, counts = np.unique(self.mention_char_ids[left:right], return_index=True, return_counts=True)
+            # ties by the latest first occurence
+            candidates = sorted(zip(counts.tolist(), firsts.tolist(), characters.tolist()), reverse=True)
+            self.speakers_lists[i] = [(char_id, count) for (count, _, char_id) in candidates]
+            self.docs[i]._.speakers_list = self.speakers_lists[i]
+        return self.speakers_lists[i]
+    
+    
+    def fillSpeakersLists(self):
+        """
+        Makes the speakers lists the sieves did not need, e.g. for
+        QuotesEvaluator.printResults.
+        """
+        for i in self.windows:
+            self.getSpeakersList(i)
         return
+    
+    
+    def countSkippedLists(self):
+        """
+        Returns:
+            number of docs with direct speech whose speakers list was not made
+        """
+        return len(self.windows) - len(self.speakers_lists)
 
 
 
@@ -116,13 +163,6 @@ class QuoteSieve:
         self.gendered_words = gendered_words
         
 
-    def __call__(self):
-        for i, doc in enumerate(self.docs):
-            if doc._.speaker_id == None and doc._.quotes:
-                self.run(doc, i)
-            if (not doc._.speaker_id == None) and not doc._.speaker_sieve:
-                doc._.speaker_sieve = self.sieve_name
-
     def getMentionGender(self, doc):
         gender = None
         if doc._.mention:
@@ -227,10 +267,17 @@ class ClosestNameBefore(QuoteSieve):
 
 
 class MajoritySpeaker(QuoteSieve):
-    def __init__(self, docs, name_dict, gender_dict, gendered_words):
+    def __init__(self, docs, name_dict, gender_dict, gendered_words, get_speakers_list=None):
+        """
+        Args:
+            get_speakers_list: function returning the speakers list of doc i,
+                MentionSpeaker.getSpeakersList; doc._.speakers_list is read
+                if None
+        """
         QuoteSieve.__init__(self, docs, name_dict, gender_dict, gendered_words)
         self.sieve_name = "majoritySpeaker"
         self.conversationalSieve = ConversationalPattern(docs, name_dict, gender_dict, gendered_words)
+        self.get_speakers_list = get_speakers_list
     
     def run(self, doc, i):
         self.conversationalSieve.run(doc, i)
@@ -238,7 +285,8 @@ class MajoritySpeaker(QuoteSieve):
             doc._.speaker_sieve = self.conversationalSieve.sieve_name
             return
         gender = self.getMentionGender(doc)
-        for (char_id, _) in doc._.speakers_list:
+        speakers_list = doc._.speakers_list if self.get_speakers_list == None else self.get_speakers_list(i)
+        for (char_id, _) in speakers_list:
             if not gender or self.gender_dict[char_id] == gender:
                 doc._.speaker_id = char_id
                 if self.isDiffThanNeighbor(i, char_id):
@@ -1,19 +1,29 @@
 import spacy
-from spacy.tokens import Doc, Span
+from spacy.tokens import Doc, Span, Token, DocBin
+import numpy as np
 
 import quote_attribution.quote_mention
 import quote_attribution.mention_speaker
+import quote_attribution.sieve_executor
 import evaluation.quotes_evaluation
+import annotation.novel
 
 import logging
+import time
+import multiprocessing
 
 class Sieve:
     pass
 
 class QuoteAttributor:
-    def __init__(self, docs, characters):
+    def __init__(self, docs, characters, novel=None):
+        """
+        Args:
+            novel: Novel with the token columns of docs, created if not given
+        """
         self.docs = docs
         self.characters = characters
+        self.novel = annotation.novel.Novel(docs) if novel == None else novel
         
         self.name_dict = {}
         self.gender_dict = {}
@@ -26,21 +36,52 @@ class QuoteAttributor:
         
         QuoteAttributor.setExtensions()
         
-        self.qo_me = quote_attribution.quote_mention.QuoteMention(character_set, docs)
-        self.me_sp = quote_attribution.mention_speaker.MentionSpeaker(self.name_dict, self.gender_dict, docs)
+        self.qo_me = quote_attribution.quote_mention.QuoteMention(character_set, docs, self.novel)
+        self.me_sp = quote_attribution.mention_speaker.MentionSpeaker(self.name_dict, self.gender_dict, docs, novel=self.novel)
     
     def setExtensions():
         quote_attribution.quote_mention.QuoteMention.setExtensions()
         quote_attribution.mention_speaker.MentionSpeaker.setExtensions()
         
     
-    def extractSpeakers(self):
-        self.qo_me.solveMentions()
-        self.me_sp.solveSpeakers()
+    def extractSpeakers(self, start=0):
+        """
+        Attributes speakers to quotes in docs from start on; the docs before
+        start are only read as context.
+        """
+        executor = quote_attribution.sieve_executor.SieveExecutor(self.docs, start)
+        
+        logging.info("Linking mentions...")
+        executor.runMentionSieves(self.qo_me.getSieves())
+        
+        logging.info("Linking speakers...")
+        self.me_sp.makeSpeakersLists(start)
+        executor.runSpeakerSieves(self.me_sp.getSieves())
+        executor.logCounts()
+        logging.info("{} of {} speakers lists not needed by the sieves.".format(self.me_sp.countSkippedLists(), len(self.me_sp.windows)))
         
         logging.info('Speaker attribution done.')
         return self.docs
     
+    def streamSpeakers(self, start=0):
+        """
+        Attributes speakers like extractSpeakers, see
+        SieveExecutor.runStreaming.
+        
+        Yields:
+            indexes of the docs from start on as soon as their speakers are
+            final, in order
+        """
+        executor = quote_attribution.sieve_executor.SieveExecutor(self.docs, start)
+        
+        logging.info("Linking mentions and speakers...")
+        self.me_sp.makeSpeakersLists(start)
+        yield from executor.runStreaming(self.qo_me.getSieves(), self.me_sp.getSieves())
+        executor.logCounts()
+        logging.info("{} of {} speakers lists not needed by the sieves.".format(self.me_sp.countSkippedLists(), len(self.me_sp.windows)))
+        
+        logging.info('Speaker attribution done.')
+    
 class FalseQuoteAttributor:
     def __init__(self, docs, characters, quoteli3_file):
         QuoteAttributor.__init__(self, docs, characters)
@@ -54,3 +95,153 @@ class FalseQuoteAttributor:
         
         return self.docs
 
+
+
+class ShardedQuoteAttributor(QuoteAttributor):
+    """
+    Attributes speakers shard by shard in worker processes.
+    
+    The sieves read the results of at most two paragraphs before a quote and
+    one after it, so a shard starts after two paragraphs without quotes (a
+    chapter heading and narration, a narrative passage, ...) and nothing
+    it attributes depends on the other shards. Each shard is sent with the
+    paragraphs before and after it that its speakers lists count mentions in
+    as context, and the results of its own paragraphs are copied back.
+    
+    The results are the same as those of QuoteAttributor.
+    """
+    def __init__(self, docs, characters, jobs, shards=None, novel=None):
+        """
+        Args:
+            jobs: number of worker processes
+            shards: number of shards, jobs by default
+        """
+        QuoteAttributor.__init__(self, docs, characters, novel)
+        self.jobs = jobs
+        self.shards = jobs if shards == None else shards
+    
+    def findShards(self, start=0):
+        """
+        Splits the docs from start on into about self.shards shards of equal
+        length in tokens.
+        
+        Returns:
+            [(context start, start, end, context end)] of the shards
+        """
+        n = len(self.docs)
+        has_quotes = [bool(doc._.quotes) for doc in self.docs]
+        cuts = [b for b in range(max(start + 1, 2), n) if not has_quotes[b-1] and not has_quotes[b-2]]
+        
+        offsets = self.novel.offsets
+        targets = [offsets[start] + (offsets[n] - offsets[start]) * k // self.shards for k in range(1, self.shards)]
+        bounds = [start]
+        for target in targets:
+            k = np.searchsorted(offsets[cuts], target) if cuts else 0
+            if k < len(cuts) and cuts[k] > bounds[-1]:
+                bounds.append(cuts[k])
+        bounds.append(n)
+        
+        # the first mention after each shard, the speakers lists of its last
+        # quotes must see the same mentions after them as in the whole novel
+        char_ids = self.novel.char_id
+        is_mention = (char_ids != self.novel.NO_CHARACTER) & (char_ids != 0) & (char_ids != -1) & ~self.novel.is_direct_speech
+        positions = np.flatnonzero(is_mention)
+        
+        shards = []
+        for b, e in zip(bounds[:-1], bounds[1:]):
+            context_start = min(max(0, b - 2), np.searchsorted(offsets, offsets[b] - self.me_sp.window_before, side='right') - 1)
+            if b == start:
+                # the quotes before start were attributed before, their
+                # mentions can point to any previous doc
+                context_start = 0
+            end_token = offsets[e] + self.me_sp.window_after
+            k = np.searchsorted(positions, offsets[e])
+            if k < len(positions):
+                end_token = max(end_token, positions[k] + 1)
+            context_end = min(n, np.searchsorted(offsets, end_token, side='left'))
+            shards.append((int(max(context_start, 0)), b, e, int(context_end)))
+        return shards
+    
+    def extractSpeakers(self, start=0):
+        shards = self.findShards(start)
+        if self.jobs <= 1 or len(shards) <= 1:
+            return QuoteAttributor.extractSpeakers(self, start)
+        
+        logging.info("Attributing speakers in {} shards...".format(len(shards)))
+        begin = time.time()
+        tasks = []
+        for (context_start, b, e, context_end) in shards:
+            doc_bytes = DocBin(store_user_data=True, docs=self.docs[context_start:context_end]).to_bytes()
+            tasks.append((doc_bytes, b - context_start, e - context_start))
+        with multiprocessing.get_context('spawn').Pool(min(self.jobs, len(shards)), initializer=initAttributionWorker, initargs=(self.characters,)) as pool:
+            results = pool.map(attributionWorker, tasks)
+        
+        self.me_sp.makeSpeakersLists(start)
+        for (context_start, b, e, context_end), shard_results in zip(shards, results):
+            for i, (mention, mention_sieve, speaker_id, speaker_sieve, speakers_list) in enumerate(shard_results, b):
+                doc = self.docs[i]
+                if mention:
+                    (j, (m_start, m_end)) = mention
+                    mention = (j + context_start, (m_start, m_end))
+                doc._.mention = mention
+                doc._.mention_sieve = mention_sieve
+                doc._.speaker_id = speaker_id
+                doc._.speaker_sieve = speaker_sieve
+                if not speakers_list == None:
+                    speakers_list = [(char_id, count) for (char_id, count) in speakers_list]
+                    self.me_sp.speakers_lists[i] = speakers_list
+                doc._.speakers_list = speakers_list
+        
+        executor = quote_attribution.sieve_executor.SieveExecutor(self.docs, start)
+        executor.countResults()
+        executor.logCounts()
+        logging.info("{} of {} speakers lists not needed by the sieves.".format(self.me_sp.countSkippedLists(), len(self.me_sp.windows)))
+        logging.info('Speaker attribution done in {:.1f} s.'.format(time.time() - begin))
+        return self.docs
+    
+    def streamSpeakers(self, start=0):
+        """
+        The shards are attributed all at once, the docs are yielded after
+        all of them.
+        """
+        self.extractSpeakers(start)
+        yield from range(start, len(self.docs))
+
+
+# the characters of a worker process of ShardedQuoteAttributor, set once per worker
+worker_characters = None
+worker_vocab = None
+
+def initAttributionWorker(characters):
+    global worker_characters, worker_vocab
+    import annotation.annotation as annotation
+    import character_extraction.character_extraction as character_extraction
+    
+    # the extensions are set unless the main module of the spawned process already set them
+    if not Doc.has_extension("cluster_ids"):
+        annotation.CorefModel.setExtensions()
+    if not Token.has_extension("is_honorific"):
+        annotation.EntityModifier.setExtensions()
+    if not Doc.has_extension("quotes"):
+        annotation.QuoteParser.setExtensions()
+    if not Span.has_extension("nameless_name"):
+        annotation.Annotator.setExtensions()
+    character_extraction.CharacterExtractor.setExtensions()
+    QuoteAttributor.setExtensions()
+    
+    worker_characters = characters
+    worker_vocab = spacy.blank("en").vocab
+
+
+def attributionWorker(task):
+    """
+    Attributes the speakers of the docs [start, end) of a shard.
+    
+    Returns:
+        (mention, mention_sieve, speaker_id, speaker_sieve, speakers_list) of
+        these docs, mentions indexed in the shard
+    """
+    (doc_bytes, start, end) = task
+    docs = list(DocBin().from_bytes(doc_bytes).get_docs(worker_vocab))
+    QuoteAttributor(docs, worker_characters).extractSpeakers(start)
+    return [(doc._.mention, doc._.mention_sieve, doc._.speaker_id, doc._.speaker_sieve, doc._.speakers_list) for doc in docs[start:end]]
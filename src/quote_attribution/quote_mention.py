@@ -1,10 +1,16 @@
-from spacy.tokens import Doc, Span
+from spacy.tokens import Doc
+from spacy.symbols import VERB, AUX
 import logging
+import numpy as np
+
+import quote_attribution.sieve_executor
+import annotation.novel
 
 class QuoteMention:
-    def __init__(self, character_set, docs):
+    def __init__(self, character_set, docs, novel=None):
         self.character_set = character_set
         self.docs = docs
+        self.novel = annotation.novel.Novel(docs) if novel == None else novel
             
         return
     
@@ -12,74 +18,98 @@ class QuoteMention:
         Doc.set_extension("mention", default=None, force=True)
         Doc.set_extension("mention_sieve", default=None, force=True)
         
-    def solveMentions(self):
+    def solveMentions(self, start=0):
+        """
+        Finds the mentions of speakers of quotes in docs from start on.
+        """
         logging.info("Linking mentions...")
-        sieves = []
-        sieves.append(TrigramMatch(self.docs, self.character_set))
-        sieves.append(PreviousParDetermined(self.docs, self.character_set))
-        sieves.append(CommonSpeechVerb(self.docs, self.character_set))
-        sieves.append(SingleMention(self.docs, self.character_set))
-        sieves.append(PreviousVocativeDetection(self.docs, self.character_set))
-        sieves.append(FinalMention(self.docs, self.character_set))
-        sieves.append(ConversationalPattern(self.docs, self.character_set))
-        sieves.append(LooseConversationalPattern(self.docs, self.character_set))
-        
-        for sieve in sieves:
-            sieve()
+        executor = quote_attribution.sieve_executor.SieveExecutor(self.docs, start)
+        executor.runMentionSieves(self.getSieves())
         return
+    
+    def getSieves(self):
+        tables = MentionTables(self.novel, self.character_set)
+        sieves = []
+        sieves.append(TrigramMatch(self.docs, self.character_set, tables))
+        sieves.append(PreviousParDetermined(self.docs, self.character_set, tables))
+        sieves.append(CommonSpeechVerb(self.docs, self.character_set, tables))
+        sieves.append(SingleMention(self.docs, self.character_set, tables))
+        sieves.append(PreviousVocativeDetection(self.docs, self.character_set, tables))
+        sieves.append(FinalMention(self.docs, self.character_set, tables))
+        sieves.append(ConversationalPattern(self.docs, self.character_set, tables))
+        sieves.append(LooseConversationalPattern(self.docs, self.character_set, tables))
+        return sieves
 
-class MentionSieve:
-    def __init__(self, docs, character_set):
-        self.docs = docs
+class MentionTables:
+    """
+    The MentionTable of each doc, built the first time a sieve reads it.
+    """
+    def __init__(self, novel, character_set):
+        self.novel = novel
         self.character_set = character_set
-        self.pronouns_nominative = ['he', 'she', 'i']
-        self.pronouns_other = ['his', 'him', 'her']
-        self.common_mentions = ['man', 'woman', 'girl', 'boy', 'wife', 'husband', 'brother', 'sister']
-        self.speech_verbs = [   'say',
-                                'cry',
-                                'reply',
-                                'add',
-                                'think',
-                                'observe',
-                                'call',
-                                'answer',
-                                'whisper',
-                                'shout',
-                                'sigh',
-                                'ask',
-                                'mutter',
-                                'repeat']
+        self.tables = {}
+    
+    def get(self, i):
+        if not i in self.tables:
+            self.tables[i] = MentionTable(self.novel, i, self.character_set)
+        return self.tables[i]
 
-    def __call__(self):
-        for i, doc in enumerate(self.docs):
-            if not doc._.mention and doc._.quotes:
-                self.run(doc, i)
-                if doc._.mention:
-                    doc._.mention_sieve = self.sieve_name
+class MentionTable:
+    """
+    Analysis of a doc read by all mention sieves, computed once: the subject
+    of each verb, the speech verbs, the kinds of the candidate mention spans
+    and the vocatives, all looked up by token index or span boundaries.
+    Each part is computed when a sieve first needs it.
+    """
+    pronouns_nominative = {'he', 'she', 'i'}
+    pronouns_other = {'his', 'him', 'her'}
+    common_mentions = {'man', 'woman', 'girl', 'boy', 'wife', 'husband', 'brother', 'sister'}
+    speech_verb_lemmas = {'say',
+                          'cry',
+                          'reply',
+                          'add',
+                          'think',
+                          'observe',
+                          'call',
+                          'answer',
+                          'whisper',
+                          'shout',
+                          'sigh',
+                          'ask',
+                          'mutter',
+                          'repeat'}
+    vocative_separators = {',', ';', '?', '!'}
     
-    def isMention(self, doc, span):
-        if len(span) == 1:
-            if span[0].lower_ in self.pronouns_nominative:
-                return True
-            if span[0].lower_ in self.common_mentions:
-                return True
-        if span.text in self.character_set:
-            return True
-        for (start, end, _, _) in doc._.coref_ents:
-            if span.start == start and span.end == end and not (span.text.lower() in self.pronouns_other):
-                return True
-        #if not span.root._.char_id == None:
-        #    return True
-        return False
+    def __init__(self, novel, i, character_set):
+        self.doc = novel.docs[i]
+        self.character_set = character_set
+        self.char_ids = novel.column('char_id', i)
+        self.direct_speech = novel.column('is_direct_speech', i)
+        self.pos = novel.column('pos', i)
+        self.coref_spans = set((start, end) for (start, end, _, _) in self.doc._.coref_ents)
+        self.mention_kinds = {}     # (start, end) -> kind of mention or None
+        self.subjects = None        # verb index -> (start, end) of its subject, passive subjects too
+        self.speech_verbs = None    # speech verb index -> (start, end) of its active subject, in doc order
+        self.all_mentions = None    # subjects outside direct speech that are mentions, in doc order
+        self.vocatives = None       # see getVocatives
     
-    def isSpeechVerb(self, token):
-        if token.pos_ == "VERB":
-            if not token._.is_direct_speech:
-                if token.lemma_.lower() in self.speech_verbs:
-                    return True
-        return False
+    def analyzeVerbs(self):
+        self.subjects = {}
+        self.speech_verbs = {}
+        self.all_mentions = []
+        for k in np.flatnonzero((self.pos == VERB) | (self.pos == AUX)).tolist():
+            token = self.doc[k]
+            subj = MentionTable.findSubject(token)
+            if subj:
+                self.subjects[k] = subj
+            if self.direct_speech[k]:
+                continue
+            if subj and self.isMention(subj[0], subj[1]):
+                self.all_mentions.append(subj)
+            if self.pos[k] == VERB and token.lemma_.lower() in self.speech_verb_lemmas:
+                self.speech_verbs[token.i] = MentionTable.findSubject(token, passive_too=False)
     
-    def getSubjIndices(self, root, passive_too=True):
+    def findSubject(root, passive_too=True):
         if not (root.pos_ == "VERB" or root.pos_ == "AUX"):
             return None
         subject = []
@@ -103,64 +133,159 @@ class MentionSieve:
         
         return (subject_start, subject_end)
     
+    def mentionKind(self, start, end):
+        """
+        Returns:
+            "pronoun", "common", "name", "coref" or None if the span is not a mention
+        """
+        if (start, end) in self.mention_kinds:
+            return self.mention_kinds[(start, end)]
+        kind = None
+        span = self.doc[start:end]
+        if len(span) == 1 and span[0].lower_ in self.pronouns_nominative:
+            kind = "pronoun"
+        elif len(span) == 1 and span[0].lower_ in self.common_mentions:
+            kind = "common"
+        elif span.text in self.character_set:
+            kind = "name"
+        elif (start, end) in self.coref_spans and not (span.text.lower() in self.pronouns_other):
+            kind = "coref"
+        self.mention_kinds[(start, end)] = kind
+        return kind
     
-    def getAllMentions(self, doc):
-        all_mentions = []
-        for token in doc:
-            if token._.is_direct_speech:
-                continue
-            if token.pos_ == "VERB" or token.pos_ == "AUX":
-                subj = self.getSubjIndices(token)
-                if subj and self.isMention(doc, Span(doc, subj[0], subj[1])):
-                    all_mentions.append(subj)
-        return all_mentions
+    def isMention(self, start, end):
+        return not self.mentionKind(start, end) == None
+    
+    def getSubject(self, i):
+        if self.subjects == None:
+            self.analyzeVerbs()
+        return self.subjects.get(i)
+    
+    def getSpeechVerbs(self):
+        if self.speech_verbs == None:
+            self.analyzeVerbs()
+        return self.speech_verbs
+    
+    def getAllMentions(self):
+        if self.all_mentions == None:
+            self.analyzeVerbs()
+        return self.all_mentions
+    
+    def isSpeechVerb(self, i):
+        return i in self.getSpeechVerbs()
     
-    def getReallyAllMentions(self, doc):
-        all_mentions = []
-        for token in doc:
-            if token._.is_direct_speech:
+    def getVocatives(self):
+        """
+        Returns:
+            [(start, end)] of the parts of the sentences, split on punctuation,
+            that are direct speech addressing a character, in doc order
+        """
+        if self.vocatives == None:
+            self.vocatives = self.findVocatives()
+        return self.vocatives
+    
+    def findVocatives(self):
+        """
+        The name lookups are cheaper than reading the direct speech marks, so
+        the marks are only checked for the parts addressing a character.
+        """
+        doc = self.doc
+        people_addressed = []
+        for sent in doc.sents:
+            separators = [token.i for token in sent if (token.text in self.vocative_separators) and sent.end-1 > token.i]
+            if not separators:
                 continue
-            if token._.char_id:
-                all_mentions.append((token.i, token.i+1))
-        return all_mentions
+            end = sent.end-1 if doc[sent.end-1].is_punct else sent.end
+            starts = [sent.start] + [separator + 1 for separator in separators]
+            ends = separators + [end]
+            for part_start, part_end in zip(starts, ends):
+                addr = self.getVocative(part_start, part_end)
+                if addr and self.isDirectSpeech(part_start, part_end):
+                    people_addressed.append(addr)
+        return people_addressed
+    
+    def isDirectSpeech(self, start, end):
+        for k in np.flatnonzero(~self.direct_speech[start:end]).tolist():
+            if not self.doc[start+k].is_quote:
+                return False
+        return True
+    
+    def getCharacterMentions(self):
+        """
+        Returns:
+            [(i, i+1)] of the tokens outside direct speech marked with a character
+        """
+        marked = (self.char_ids != annotation.novel.Novel.NO_CHARACTER) & (self.char_ids != 0) & ~self.direct_speech
+        return [(k, k+1) for k in np.flatnonzero(marked).tolist()]
+    
+    def getVocative(self, start, end):
+        doc = self.doc
+        if self.spanText(start, end) in self.character_set:
+            return start, end
+        if end - start >= 2 and (doc[start].lower_ == "my" or doc[start].pos_ == "ADJ"):
+            if self.spanText(start+1, end) in self.character_set:
+                return start, end
+        if end - start >= 3 and doc[start].lower_ == "my" and doc[start+1].pos_ == "ADJ":
+            if self.spanText(start+2, end) in self.character_set:
+                return start, end
+        return None
+    
+    def spanText(self, start, end):
+        """
+        Text of doc[start:end], sliced from the doc text without creating a span.
+        """
+        if end <= start:
+            return ""
+        last = self.doc[end-1]
+        return self.doc.text[self.doc[start].idx:last.idx + len(last.text)]
+
+class MentionSieve:
+    def __init__(self, docs, character_set, tables=None):
+        self.docs = docs
+        self.character_set = character_set
+        self.tables = MentionTables(annotation.novel.Novel(docs), character_set) if tables == None else tables
+    
+    def getTable(self, i):
+        return self.tables.get(i)
     
     
 
 class TrigramMatch(MentionSieve):
-    def __init__(self, docs, character_set):
-        MentionSieve.__init__(self, docs, character_set)
+    def __init__(self, docs, character_set, tables=None):
+        MentionSieve.__init__(self, docs, character_set, tables)
         self.sieve_name = "trigramMatch"
     
     def run(self, doc, i):
+        table = self.getTable(i)
         for q_start, q_end in doc._.quotes:
             if q_end < len(doc) - 1:
-                after_1 = doc[q_end]
-                after_2 = doc[q_end+1]
+                after_1 = q_end
+                after_2 = q_end+1
                 # Quote-Mention-Verb
-                if self.isMention(doc, doc[after_1.i:after_1.i+1]):
-                    if self.isSpeechVerb(after_2):
+                if table.isMention(after_1, after_1+1):
+                    if table.isSpeechVerb(after_2):
                         doc._.mention = ((i, (q_end, q_end+1)))
                 # Quote-Verb-Mention
-                if self.isMention(doc, doc[after_2.i:after_2.i+1]):
-                    if self.isSpeechVerb(after_1):
+                if table.isMention(after_2, after_2+1):
+                    if table.isSpeechVerb(after_1):
                         doc._.mention = ((i, (q_end+1, q_end+2)))
             if q_start > 1:
-                before_1 = doc[q_start-1]
-                before_2 = doc[q_start-2]
+                before_1 = q_start-1
+                before_2 = q_start-2
                 # Mention-Verb-Quote
-                if self.isMention(doc, doc[before_1.i:before_1.i+1]):
-                    if self.isSpeechVerb(before_2):
+                if table.isMention(before_1, before_1+1):
+                    if table.isSpeechVerb(before_2):
                         doc._.mention = ((i, (q_start-1, q_start)))
                 # Verb-Mention-Quote
-                if self.isMention(doc, doc[before_2.i:before_2.i+1]):
-                    if self.isSpeechVerb(before_1):
+                if table.isMention(before_2, before_2+1):
+                    if table.isSpeechVerb(before_1):
                         doc._.mention = ((i, (q_start-2, q_start-1)))
         return
 
 
 class PreviousParDetermined(MentionSieve):
-    def __init__(self, docs, character_set):
-        MentionSieve.__init__(self, docs, character_set)
+    def __init__(self, docs, character_set, tables=None):
+        MentionSieve.__init__(self, docs, character_set, tables)
         self.sieve_name = "previousParDetermined"
     
     def run(self, doc, i):
@@ -173,101 +298,70 @@ class PreviousParDetermined(MentionSieve):
                 if (verb.pos_ == "VERB" or verb.pos_ == "AUX")  and verb.dep_ == "conj" and verb.head in verbs:
                     verbs.append(verb)
             
+            table = self.getTable(i-1)
             for verb in verbs:
-                subj = self.getSubjIndices(verb)
-                if subj and self.isMention(prev_doc, Span(prev_doc, subj[0], subj[1])):
+                subj = table.getSubject(verb.i)
+                if subj and table.isMention(subj[0], subj[1]):
                     doc._.mention = (i-1, subj)
         return
 
 
 class CommonSpeechVerb(MentionSieve):
-    def __init__(self, docs, character_set):
-        MentionSieve.__init__(self, docs, character_set)
+    def __init__(self, docs, character_set, tables=None):
+        MentionSieve.__init__(self, docs, character_set, tables)
         self.sieve_name = "commonSpeechVerb"
     
     def run(self, doc, i):
-        for token in doc:
-            if self.isSpeechVerb(token):
-                subj = self.getSubjIndices(token, passive_too=False)
-                if subj:
-                    doc._.mention = (i, subj)
-                    return
+        for subj in self.getTable(i).getSpeechVerbs().values():
+            if subj:
+                doc._.mention = (i, subj)
+                return
         return
 
 
 class SingleMention(MentionSieve):
-    def __init__(self, docs, character_set):
-        MentionSieve.__init__(self, docs, character_set)
+    def __init__(self, docs, character_set, tables=None):
+        MentionSieve.__init__(self, docs, character_set, tables)
         self.sieve_name = "singleMention"
     
     def run(self, doc, i):
-        all_mentions = self.getReallyAllMentions(doc)
+        table = self.getTable(i)
+        all_mentions = table.getCharacterMentions()
         if len(all_mentions) == 1:
             doc._.mention = (i, all_mentions[0])
         elif all_mentions:
-            first_mention = doc[all_mentions[0][0]:all_mentions[0][1]]
+            first_char_id = table.char_ids[all_mentions[0][0]]
             for men in all_mentions:
-                char_id = doc[men[0]:men[1]].root._.char_id
-                if not char_id == first_mention.root._.char_id:
+                if not table.char_ids[men[0]] == first_char_id:
                     return
             doc._.mention = (i, all_mentions[0])
         return
 
 
 class PreviousVocativeDetection(MentionSieve):
-    def __init__(self, docs, character_set):
-        MentionSieve.__init__(self, docs, character_set)
+    def __init__(self, docs, character_set, tables=None):
+        MentionSieve.__init__(self, docs, character_set, tables)
         self.sieve_name = "previousVocativeDetection"
     
     def run(self, doc, i):
         if i <= 0:
             return
-        prev_doc = self.docs[i-1]
-        all_vocatives = self.extractVocatives(prev_doc)
+        all_vocatives = self.getTable(i-1).getVocatives()
         if all_vocatives:
             doc._.mention = (i-1, all_vocatives[-1])
         return
     
-    def extractVocatives(self, doc):
-        people_addressed = []
-        for sent in doc.sents:
-            separators = [token.i for token in sent if (token.text in [',', ';', '?', '!']) and sent.end-1 > token.i]
-            parts = []
-            if separators:
-                parts.append(Span(doc, max(0, sent.start), separators[0]))
-                for i in range(1, len(separators)):
-                    parts.append(Span(doc, separators[i-1]+1, separators[i]))
-                end = sent.end-1 if doc[sent.end-1].is_punct else sent.end
-                parts.append(Span(doc, separators[-1]+1, end))
-            for part in parts:
-                if part._.is_direct_speech:
-                    addr = self.getVocative(part)
-                    if addr:
-                        people_addressed.append(addr)
-        return people_addressed
-    
-    def getVocative(self, span):
-        if span.text in self.character_set:
-            return span.start, span.end
-        if len(span) >= 2 and span[1:].text in self.character_set:
-            if span[0].lower_ == "my" or span[0].pos_ == "ADJ":
-                return span.start, span.end
-        if len(span) >= 3 and span[2:].text in self.character_set:
-            if span[0].lower_ == "my" and span[1].pos_ == "ADJ":
-                return span.start, span.end
-        return None
-
 
 class FinalMention(MentionSieve):
-    def __init__(self, docs, character_set):
-        MentionSieve.__init__(self, docs, character_set)
+    def __init__(self, docs, character_set, tables=None):
+        MentionSieve.__init__(self, docs, character_set, tables)
         self.sieve_name = "finalMention"
     
     def run(self, doc, i):
         if not doc.text.endswith('"'):
             return
     
-        all_mentions = self.getAllMentions(doc)
+        all_mentions = self.getTable(i).getAllMentions()
         
         if not all_mentions:
             return
@@ -285,8 +379,8 @@ class FinalMention(MentionSieve):
 
 
 class ConversationalPattern(MentionSieve):
-    def __init__(self, docs, character_set):
-        MentionSieve.__init__(self, docs, character_set)
+    def __init__(self, docs, character_set, tables=None):
+        MentionSieve.__init__(self, docs, character_set, tables)
         self.sieve_name = "conversationalPattern"
     
     def run(self, doc, i):
@@ -300,8 +394,8 @@ class ConversationalPattern(MentionSieve):
 
 
 class LooseConversationalPattern(MentionSieve):
-    def __init__(self, docs, character_set):
-        MentionSieve.__init__(self, docs, character_set)
+    def __init__(self, docs, character_set, tables=None):
+        MentionSieve.__init__(self, docs, character_set, tables)
         self.sieve_name = "looseConversationalPattern"
     
     def run(self, doc, i):
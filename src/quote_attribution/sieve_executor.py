@@ -0,0 +1,117 @@
+import logging
+from collections import Counter
+
+
+class SieveExecutor:
+    """
+    Runs the mention sieves and then the speaker sieves in their order, each
+    over the docs with quotes only. The docs with quotes are found once, so
+    the paragraphs without dialogue, usually most of a novel, are not
+    visited by every sieve.
+    
+    The results are the same as when every sieve goes over all docs. The
+    number of docs resolved by each sieve is kept in mention_counts and
+    speaker_counts.
+    """
+    def __init__(self, docs, start=0):
+        self.docs = docs
+        self.start = start
+        self.quote_docs = [i for i in range(start, len(docs)) if docs[i]._.quotes]
+        self.mention_counts = Counter()
+        self.speaker_counts = Counter()
+    
+    def runMentionSieves(self, sieves):
+        for sieve in sieves:
+            for i in self.quote_docs:
+                self.runMentionSieve(sieve, i)
+        return
+    
+    def runSpeakerSieves(self, sieves):
+        for sieve in sieves:
+            for i in self.quote_docs:
+                self.runSpeakerSieve(sieve, i)
+        self.countSpeakers()
+        return
+    
+    def runMentionSieve(self, sieve, i):
+        doc = self.docs[i]
+        if not doc._.mention:
+            sieve.run(doc, i)
+            if doc._.mention:
+                doc._.mention_sieve = sieve.sieve_name
+                self.mention_counts[sieve.sieve_name] += 1
+    
+    def runSpeakerSieve(self, sieve, i):
+        doc = self.docs[i]
+        if doc._.speaker_id == None:
+            sieve.run(doc, i)
+        if (not doc._.speaker_id == None) and not doc._.speaker_sieve:
+            doc._.speaker_sieve = sieve.sieve_name
+    
+    def countSpeakers(self):
+        for i in self.quote_docs:
+            if self.docs[i]._.speaker_sieve:
+                self.speaker_counts[self.docs[i]._.speaker_sieve] += 1
+    
+    def runStreaming(self, mention_sieves, speaker_sieves):
+        """
+        Runs the same sieves as runMentionSieves and runSpeakerSieves with
+        the same results, but yields the docs as soon as their results are
+        final instead of after the last sieve went over the whole book.
+        
+        A sieve reads the results of the docs up to two before and one after
+        the doc it runs on. It runs on a doc once the previous sieve ran on
+        the docs up to two after it, so the docs it reads already have the
+        results of the previous sieves and none of the next ones, as when
+        every sieve goes over all docs before the next one.
+        
+        Yields:
+            indexes of the docs from start on, in order
+        """
+        stages = [(self.runMentionSieve, sieve) for sieve in mention_sieves] + [(self.runSpeakerSieve, sieve) for sieve in speaker_sieves]
+        # done[k]: the number of quote docs stage k ran on
+        done = [0] * len(stages)
+        n = len(self.quote_docs)
+        next_doc = self.start
+        
+        while done and done[-1] < n:
+            if done[0] < n:
+                (run, sieve) = stages[0]
+                run(sieve, self.quote_docs[done[0]])
+                done[0] += 1
+            for k in range(1, len(stages)):
+                (run, sieve) = stages[k]
+                # the next doc of the previous stage must be more than two docs further
+                while done[k] < n and (done[k-1] == n or self.quote_docs[done[k]] + 2 < self.quote_docs[done[k-1]]):
+                    run(sieve, self.quote_docs[done[k]])
+                    done[k] += 1
+            final = len(self.docs) if done[-1] == n else self.quote_docs[done[-1]]
+            while next_doc < final:
+                yield next_doc
+                next_doc += 1
+        self.countSpeakers()
+        while next_doc < len(self.docs):
+            yield next_doc
+            next_doc += 1
+    
+    def countResults(self):
+        """
+        Counts the docs resolved by each sieve from the sieve names saved in
+        the docs, when the sieves were run elsewhere.
+        """
+        self.mention_counts = Counter()
+        self.speaker_counts = Counter()
+        for i in self.quote_docs:
+            doc = self.docs[i]
+            if doc._.mention_sieve:
+                self.mention_counts[doc._.mention_sieve] += 1
+            if doc._.speaker_sieve:
+                self.speaker_counts[doc._.speaker_sieve] += 1
+        return
+    
+    def logCounts(self):
+        logging.info("{} docs with quotes.".format(len(self.quote_docs)))
+        for name, count in self.mention_counts.most_common():
+            logging.info("\tmention found by {}: {}".format(name, count))
+        for name, count in self.speaker_counts.most_common():
+            logging.info("\tspeaker found by {}: {}".format(name, count))
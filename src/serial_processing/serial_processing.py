@@ -0,0 +1,296 @@
+import logging
+from collections import Counter
+import numpy as np
+
+import character_extraction.character_extraction as character_extraction
+import quote_attribution.quote_attribution as quote_attribution
+import network_creation.network_creation as network_creation
+
+
+class SerialNovel:
+    """
+    A novel published chapter by chapter, processed incrementally.
+
+    Appending a chapter annotates only its paragraphs, with the tail of the
+    previous chapters as coreference context. Characters are extracted again
+    from the whole text, as the name pair features depend on all of it, but
+    no old paragraph goes through the language or coreference model again,
+    and the ids of the characters found in previous chapters are kept.
+
+    Only the quotes whose speakers can depend on new or changed paragraphs,
+    or on the names and genders of the characters, are attributed again, and
+    the network edge weights are updated in place by subtracting the old
+    contributions of these paragraphs and adding the new ones.
+    """
+
+    def __init__(self, annotator, docs=[], model_path="models/all_data.model", edge_maxprob=0.9, character_remove_limit=3):
+        """
+        Args:
+            annotator: Annotator used for the new chapters
+            docs: annotated docs of the chapters processed so far
+        """
+        character_extraction.CharacterExtractor.setExtensions()
+        quote_attribution.QuoteAttributor.setExtensions()
+
+        self.annotator = annotator
+        self.docs = list(docs)
+        self.model_path = model_path
+        self.edge_maxprob = edge_maxprob
+        self.character_remove_limit = character_remove_limit
+        self.characters = None
+
+        self.nameless_characters = annotator.findNamelessCharacters(self.docs)
+        if self.docs:
+            annotator.coref.current_cluster_id = max(annotator.coref.current_cluster_id, self.docs[-1]._.cluster_ids[1])
+
+        self.char_sets = [self.docCharacters(doc) for doc in self.docs]
+        self.conversation_weights = Counter()
+        self.cooccurrence_weights = Counter()
+        for i in range(len(self.docs)):
+            self.addCooccurrence(self.char_sets[i], 1)
+            self.addConversation(i, 1)
+
+
+    def addChapter(self, paragraphs):
+        """
+        Annotates the paragraphs of a new chapter and updates the characters,
+        the speakers and the network edge weights.
+
+        Returns:
+            index of the first doc whose quotes were attributed again
+        """
+        n_old = len(self.docs)
+        old_states = [self.docState(doc) for doc in self.docs]
+        old_characters = self.characters
+
+        logging.info("Annotating {} new paragraphs...".format(len(paragraphs)))
+        self.docs += self.annotator.annotateMore(self.docs, paragraphs, self.nameless_characters)
+        self.extractCharacters()
+
+        changed = [i for i in range(n_old) if not self.docState(self.docs[i]) == old_states[i]]
+        attributor = quote_attribution.QuoteAttributor(self.docs, self.characters)
+        first_changed = min(changed[:1] + [self.changedCharactersStart(old_characters, attributor.novel), n_old])
+        start = self.affectedStart(first_changed, attributor.me_sp)
+        logging.info("{} previous paragraphs changed, attributing quotes again from paragraph {}.".format(len(changed), start))
+
+        for i in changed:
+            self.addCooccurrence(self.char_sets[i], -1)
+            self.char_sets[i] = self.docCharacters(self.docs[i])
+            self.addCooccurrence(self.char_sets[i], 1)
+        for i in range(n_old, len(self.docs)):
+            self.char_sets.append(self.docCharacters(self.docs[i]))
+            self.addCooccurrence(self.char_sets[i], 1)
+
+        for i in range(start, n_old):
+            self.addConversation(i, -1)
+        self.resetSpeakers(start)
+        attributor.extractSpeakers(start)
+        for i in range(start, len(self.docs)):
+            self.addConversation(i, 1)
+
+        return start
+
+
+    def extractCharacters(self):
+        """
+        Extracts the characters from all docs. Characters sharing names with
+        the characters found before get their ids.
+        """
+        previous = self.previousCharacters()
+        for doc in self.docs:
+            for token in doc:
+                token._.char_id = None
+
+        extractor = character_extraction.CharacterExtractor(self.docs)
+        characters = extractor.extractCharacters(self.model_path, self.edge_maxprob, self.character_remove_limit)
+
+        mapping = self.stableIds(characters, previous)
+        for doc in self.docs:
+            for token in doc:
+                if not token._.char_id == None:
+                    token._.char_id = mapping[token._.char_id]
+        self.characters = dict((mapping[char_id], character) for char_id, character in characters.items())
+        return self.characters
+
+
+    def previousCharacters(self):
+        """
+        Returns:
+            {char_id: Counter of names} of the characters marked in the docs
+        """
+        previous = {}
+        for doc in self.docs:
+            for ent in doc.ents:
+                char_id = ent.root._.char_id
+                if char_id == None:
+                    continue
+                if ent.label_ == "NARRATOR":
+                    name = "(THE NARRATOR)"
+                elif ent.label_ == "NAMELESS_CHAR" and ent._.nameless_name:
+                    name = ent._.nameless_name
+                else:
+                    name = ent.text
+                previous.setdefault(char_id, Counter())[name] += 1
+        return previous
+
+
+    def stableIds(self, characters, previous):
+        """
+        Matches the new characters to the previous ones by the occurences of
+        their shared names, greedily from the best match. Unmatched characters
+        get ids not used before.
+
+        Returns:
+            {new char_id: stable char_id}
+        """
+        name_ids = {}
+        for old_id, names in previous.items():
+            for name, count in names.items():
+                name_ids.setdefault(name, Counter())[old_id] += count
+
+        candidates = []
+        for char_id, (variants, gender) in characters.items():
+            scores = Counter()
+            for name, count in variants:
+                scores.update(name_ids.get(name, Counter()))
+            for old_id, score in scores.items():
+                candidates.append((score, char_id, old_id))
+        candidates.sort(reverse=True)
+
+        mapping, used = {}, set()
+        for score, char_id, old_id in candidates:
+            if char_id in mapping or old_id in used:
+                continue
+            mapping[char_id] = old_id
+            used.add(old_id)
+
+        next_id = max(list(previous) + [-1]) + 1
+        for char_id in sorted(characters):
+            if not char_id in mapping:
+                mapping[char_id] = next_id
+                next_id += 1
+        return mapping
+
+
+    def docState(self, doc):
+        """
+        The annotations of an old doc that the next chapter can change.
+        """
+        return ([token._.char_id for token in doc], len(doc.ents), len(doc._.coref_ents))
+
+
+    def changedCharactersStart(self, old_characters, novel):
+        """
+        Index of the first doc whose quotes can be attributed differently
+        with the new characters than with old_characters, as the sieves look
+        up the names of the characters in the text and compare their genders.
+        """
+        if old_characters == None:
+            return len(self.docs)
+        old_names, old_genders = self.nameGenderDicts(old_characters)
+        names, genders = self.nameGenderDicts(self.characters)
+        changed_names = set(name for name in set(old_names) | set(names) if not old_names.get(name) == names.get(name))
+        if "(THE NARRATOR)" in changed_names:
+            changed_names.add("I")
+        changed_ids = [char_id for char_id in genders if char_id in old_genders and not genders[char_id] == old_genders[char_id]]
+
+        first = len(self.docs)
+        positions = np.flatnonzero(np.isin(novel.char_id, changed_ids))
+        if len(positions):
+            first = int(np.searchsorted(novel.offsets, positions[0], side='right')) - 1
+        for i in range(first):
+            if any(name in self.docs[i].text for name in changed_names):
+                return i
+        return first
+
+
+    def nameGenderDicts(self, characters):
+        """
+        Returns:
+            ({name: char_id}, {char_id: gender}) as made by QuoteAttributor
+        """
+        name_dict, gender_dict = {}, {}
+        for char_id, (var_list, gender) in characters.items():
+            for (name, count) in var_list:
+                name_dict[name] = char_id
+            gender_dict[char_id] = gender
+        return name_dict, gender_dict
+
+
+    def affectedStart(self, first_changed, me_sp):
+        """
+        Index of the first doc whose speaker can depend on the docs from
+        first_changed on, so that attributing the quotes again from it gives
+        the same speakers as attributing the whole novel:
+
+        - the speakers lists count the mentions up to window_after tokens
+          after a quote, and a list with no mention in its window counts
+          the last mention of the novel (see MentionSpeaker.makeSpeakersLists)
+        - the speaker sieves compare with the speaker of the next doc, so a
+          changed speaker can change all quotes before it up to the start
+          of their conversation, the docs with quotes in a row
+
+        Args:
+            me_sp: MentionSpeaker of the docs with the new characters
+        """
+        offsets = me_sp.novel.offsets
+        change = offsets[first_changed]
+        # the lists of the docs ending less than window_after tokens before the change
+        i = np.searchsorted(offsets, change - me_sp.window_after, side='right') - 1
+
+        # the lists with no mention from their window up to the change
+        positions, _ = me_sp.mentionPositions()
+        k = np.searchsorted(positions, change)
+        if k == 0:
+            i = 0
+        else:
+            i = min(i, np.searchsorted(offsets, positions[k-1] + me_sp.window_before, side='right') - 1)
+        i = max(0, min(int(i), first_changed))
+
+        while i > 0 and self.docs[i-1]._.quotes:
+            i -= 1
+        return i
+
+
+    def resetSpeakers(self, start):
+        for doc in self.docs[start:]:
+            doc._.mention = None
+            doc._.mention_sieve = None
+            doc._.speaker_id = None
+            doc._.speaker_sieve = None
+            doc._.speakers_list = None
+
+
+    def docCharacters(self, doc):
+        return frozenset([token._.char_id for token in doc if not token._.char_id == None])
+
+
+    def addCooccurrence(self, char_set, sign):
+        """
+        Adds (sign=1) or subtracts (sign=-1) the co-occurrence edges of a doc.
+        """
+        for A in char_set:
+            for B in char_set:
+                if A > B:
+                    self.cooccurrence_weights[(A, B)] += sign
+
+
+    def addConversation(self, i, sign):
+        """
+        Adds (sign=1) or subtracts (sign=-1) the conversation edge between
+        the speakers of docs i-1 and i.
+        """
+        if i == 0:
+            return
+        A, B = self.docs[i-1]._.speaker_id, self.docs[i]._.speaker_id
+        if (not A == None) and (not B == None) and (not A == B):
+            self.conversation_weights[(max(A, B), min(A, B))] += sign
+
+
+    def createNetworks(self):
+        """
+        Returns:
+            (conversation network, co-occurrence network)
+        """
+        network_creator = network_creation.NetworkCreator(self.docs, self.characters)
+        return network_creator.createNetworksFromWeights(self.conversation_weights, self.cooccurrence_weights)